@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Measures the per-value cost of encrypting and decrypting through
+# BaseEncryptedField, with the cached Cipher against rebuilding it for every value.
+#
+#     python benchmarks/cipher.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(SECRET_KEY="benchmark")
+django.setup()
+
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives.ciphers import Cipher, modes  # noqa: E402
+
+from pgcrypto.base import pad  # noqa: E402
+from pgcrypto.fields import BaseEncryptedField  # noqa: E402
+
+
+class UncachedField(BaseEncryptedField):
+    """
+    Builds a new Cipher for every value, as get_cipher used to.
+    """
+
+    def get_cipher(self, key=None):
+        return Cipher(
+            self.algorithm(key or self.active_key),
+            modes.CBC(b"\0" * self.block_size),
+            backend=default_backend(),
+        )
+
+
+def per_value(stmt, number=20000):
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number
+
+
+def main():
+    cached = BaseEncryptedField(key="benchmark key")
+    uncached = UncachedField(key="benchmark key")
+    plaintext = pad(b"666-27-9811", cached.block_size)
+    ciphertext = cached.encrypt(plaintext)
+    armored = cached.get_db_prep_save("666-27-9811", None)
+
+    cases = (
+        ("encrypt", lambda f: lambda: f.encrypt(plaintext)),
+        ("decrypt", lambda f: lambda: f.decrypt(ciphertext)),
+        ("to_python", lambda f: lambda: f.to_python(armored)),
+        ("get_db_prep_save", lambda f: lambda: f.get_db_prep_save("666-27-9811", None)),
+    )
+    print("%18s  %10s  %10s  %10s" % ("operation", "uncached", "cached", "saved"))
+    for name, make in cases:
+        before = per_value(make(uncached))
+        after = per_value(make(cached))
+        print(
+            "%18s  %8.2fus  %8.2fus  %8.2fus"
+            % (name, before * 1e6, after * 1e6, (before - after) * 1e6)
+        )
+
+
+if __name__ == "__main__":
+    main()
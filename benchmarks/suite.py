@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+#
+# Times the hot paths of django-pgcrypto, in three groups:
+#
+#   base     crc24, armor, dearmor, pad and unpad, across payload sizes
+#   fields   encrypt/decrypt round-trips for each field type, and decrypting N rows
+#            with from_db_values against calling from_db_value on each one
+#   lookups  encrypted lookups against PostgreSQL, on tables of 10^3 to 10^6 rows
+#
+# The lookups group is only run when named, and connects with the testapp settings
+# (see PGCRYPTO_TEST_* in testapp/settings.py) to a test database it creates, which
+# --keepdb keeps (with its rows) for the next run. Results are seconds per operation,
+# and can be saved, then compared against a later run:
+#
+#     python benchmarks/suite.py --output baseline.json
+#     python benchmarks/suite.py --compare baseline.json --threshold 0.1
+#     python benchmarks/suite.py lookups --sizes 1000 100000 --keepdb
+#
+# Comparing exits with status 1 if any result is slower than its baseline by more
+# than the threshold.
+
+import argparse
+import datetime
+import decimal
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testapp.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+import pgcrypto  # noqa: E402
+from pgcrypto.base import armor, crc24, dearmor, pad, unpad  # noqa: E402
+
+GROUPS = ("base", "fields", "lookups")
+PAYLOAD_SIZES = (16, 256, 4096, 65536, 1048576)
+TABLE_SIZES = (1000, 10000, 100000, 1000000)
+
+
+def measure(func, budget=0.5):
+    # Scale the number of runs so each measurement takes roughly `budget` seconds.
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= budget / 5 or number >= 100000:
+            break
+        number *= 10
+    runs = max(1, int(number * budget / max(elapsed, 1e-9)))
+    return min(timeit.repeat(func, number=runs, repeat=3)) / runs
+
+
+def bench_base(args):
+    for size in PAYLOAD_SIZES:
+        data = os.urandom(size)
+        armored = armor(data)
+        padded = pad(data, 16)
+        cases = (
+            ("crc24", lambda: crc24(data)),
+            ("armor", lambda: armor(data)),
+            ("dearmor", lambda: dearmor(armored)),
+            ("pad", lambda: pad(data, 16)),
+            ("unpad", lambda: unpad(padded, 16)),
+        )
+        for name, func in cases:
+            yield "base.%s[%d]" % (name, size), measure(func, args.budget)
+
+
+def field_cases():
+    """
+    Returns (name, field, value) for each field type, and each codec it supports.
+    """
+    today = datetime.date(2024, 6, 1)
+    now = timezone.now()
+    cases = [
+        ("text", pgcrypto.EncryptedTextField(), "Some notes about this employee."),
+        ("char", pgcrypto.EncryptedCharField(max_length=11), "666-27-9811"),
+        ("email", pgcrypto.EncryptedEmailField(), "someone@example.com"),
+    ]
+    typed = (
+        ("integer", pgcrypto.EncryptedIntegerField, 123456789),
+        ("decimal", pgcrypto.EncryptedDecimalField, decimal.Decimal("52000.00")),
+        ("date", pgcrypto.EncryptedDateField, today),
+        ("datetime", pgcrypto.EncryptedDateTimeField, now),
+    )
+    for name, cls, value in typed:
+        cases.append((name, cls(), value))
+        cases.append(("%s.binary" % name, cls(codec="binary"), value))
+    return cases
+
+
+def bench_fields(args):
+    for name, field, value in field_cases():
+        stored = field.get_db_prep_save(value, connection)
+        assert field.to_python(stored) == value
+        yield (
+            "fields.%s.encrypt" % name,
+            measure(lambda: field.get_db_prep_save(value, connection), args.budget),
+        )
+        yield (
+            "fields.%s.decrypt" % name,
+            measure(lambda: field.to_python(stored), args.budget),
+        )
+        # Distinct values, so neither path benefits from repeats.
+        rows = [
+            field.get_db_prep_save(v, connection)
+            for v in distinct_values(value, args.rows)
+        ]
+        yield (
+            "fields.%s.from_db_value[%d]" % (name, args.rows),
+            measure(
+                lambda: [field.from_db_value(v, None, connection) for v in rows],
+                args.budget,
+            ),
+        )
+        yield (
+            "fields.%s.from_db_values[%d]" % (name, args.rows),
+            measure(lambda: field.from_db_values(rows), args.budget),
+        )
+
+
+def distinct_values(value, count):
+    if isinstance(value, str):
+        return ["%s %d" % (value, i) for i in range(count)]
+    if isinstance(value, datetime.datetime):
+        step = datetime.timedelta(seconds=1)
+    elif isinstance(value, datetime.date):
+        step = datetime.timedelta(days=1)
+    else:
+        step = 1
+    return [value + step * i for i in range(count)]
+
+
+def lookup_cases(size):
+    """
+    Returns (name, queryset) for each lookup, with a value that matches a row of a
+    table with `size` rows.
+    """
+    from testapp.models import Customer, Employee
+
+    last = size - 1
+    return (
+        # Decrypts every row.
+        ("employee.ssn__exact", Employee.objects.filter(ssn=ssn(last))),
+        ("employee.age__gt", Employee.objects.filter(age__gt=size - 10)),
+        (
+            "employee.email__contains",
+            Employee.objects.filter(email__contains="r%d@" % last),
+        ),
+        ("employee.ssn__in", Employee.objects.filter(ssn__in=[ssn(0), ssn(last)])),
+        # Compares blind index columns.
+        ("customer.ssn__exact", Customer.objects.filter(ssn=ssn(last))),
+        ("customer.ssn__in", Customer.objects.filter(ssn__in=[ssn(0), ssn(last)])),
+        # Compares ciphertexts, using an index on Dearmor(email).
+        ("customer.email__exact", Customer.objects.filter(email=email(last))),
+        # Decrypts the rows found through the GIN index on email_tokens.
+        (
+            "customer.email__icontains",
+            Customer.objects.filter(email__icontains="r%d@" % last),
+        ),
+        # Uses the EncryptedIndex on the decrypted salary.
+        ("customer.salary__gt", Customer.objects.filter(salary__gt=salary(last - 10))),
+    )
+
+
+def ssn(i):
+    return "%03d-%02d-%04d" % (i // 1000000 % 1000, i // 10000 % 100, i % 10000)
+
+
+def email(i):
+    return "user%d@example.com" % i
+
+
+def salary(i):
+    return decimal.Decimal(i + 1)
+
+
+def load_rows(size, batch_size=10000):
+    """
+    Adds rows to the benchmark tables until they hold `size` rows, emptying them
+    first if they hold more.
+    """
+    from testapp.models import Customer, Employee
+
+    start = Customer.objects.count()
+    if start > size:
+        # Left over from a larger run (with --keepdb).
+        with connection.cursor() as c:
+            c.execute("TRUNCATE testapp_employee, testapp_customer RESTART IDENTITY")
+        start = 0
+    for offset in range(start, size, batch_size):
+        numbers = range(offset, min(offset + batch_size, size))
+        Employee.objects.bulk_create(
+            Employee(
+                name="Employee %d" % i,
+                age=i + 1,
+                ssn=ssn(i),
+                salary=salary(i),
+                email=email(i),
+            )
+            for i in numbers
+        )
+        Customer.objects.bulk_create(
+            Customer(
+                name="Customer %d" % i, ssn=ssn(i), salary=salary(i), email=email(i)
+            )
+            for i in numbers
+        )
+    with connection.cursor() as c:
+        c.execute("ANALYZE testapp_employee, testapp_customer")
+
+
+def create_schema():
+    """
+    Creates the indexes that the blind index-free lookups rely on (see the README).
+    """
+    from django.db.models import Index
+
+    from pgcrypto.indexes import EncryptedIndex
+    from pgcrypto.operations import CreateDecryptFunctions
+    from testapp.models import Customer
+
+    with connection.cursor() as c:
+        c.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto")
+        c.execute("DROP INDEX IF EXISTS customer_salary_decrypted")
+        c.execute("DROP INDEX IF EXISTS customer_email_dearmor")
+    with connection.schema_editor() as editor:
+        CreateDecryptFunctions().database_forwards("testapp", editor, None, None)
+        editor.add_index(
+            Customer,
+            EncryptedIndex(fields=["salary"], name="customer_salary_decrypted"),
+        )
+        editor.add_index(
+            Customer, Index(pgcrypto.Dearmor("email"), name="customer_email_dearmor")
+        )
+
+
+def bench_lookups(args):
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, keepdb=args.keepdb
+    )
+    try:
+        create_schema()
+        for size in sorted(args.sizes):
+            load_rows(size)
+            for name, qs in lookup_cases(size):
+                assert qs.exists(), name
+                yield (
+                    "lookups.%s[%d]" % (name, size),
+                    measure(lambda: list(qs.all()), args.budget),
+                )
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=args.keepdb)
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each result against its baseline, and returns the names of those that
+    are slower by more than `threshold` (a fraction).
+    """
+    regressions = []
+    print("%-50s  %12s  %12s  %7s" % ("benchmark", "baseline", "current", "ratio"))
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print(
+            "%-50s  %10.2fus  %10.2fus  %6.2fx%s"
+            % (name, baseline[name] * 1e6, seconds * 1e6, ratio, flag)
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "groups",
+        nargs="*",
+        default=["base", "fields"],
+        metavar="group",
+        help="Groups to run: base, fields and/or lookups (default: base fields).",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against the results in this file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown (as a fraction) that --compare reports as a regression.",
+    )
+    parser.add_argument(
+        "--budget", type=float, default=0.5, help="Seconds to spend on each timing."
+    )
+    parser.add_argument(
+        "--rows", type=int, default=1000, help="Rows decrypted in bulk by fields."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=TABLE_SIZES,
+        help="Table sizes for lookups.",
+    )
+    parser.add_argument(
+        "--keepdb", action="store_true", help="Keep the lookups test database."
+    )
+    args = parser.parse_args()
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error("unknown group: %s" % group)
+
+    benchmarks = {"base": bench_base, "fields": bench_fields, "lookups": bench_lookups}
+    results = {}
+    for group in GROUPS:
+        if group in args.groups:
+            for name, seconds in benchmarks[group](args):
+                results[name] = seconds
+                if not args.compare:
+                    print("%-50s  %10.2fus" % (name, seconds * 1e6))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "python": platform.python_version(),
+                        "django": django.get_version(),
+                        "platform": platform.platform(),
+                        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(
+                "%d of %d benchmarks regressed by more than %d%%"
+                % (len(regressions), len(results), args.threshold * 100)
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
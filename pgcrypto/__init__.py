@@ -12,14 +12,32 @@
 #
 # See http://www.ietf.org/rfc/rfc2440.txt for ASCII Armor specs.
 
-from .base import __version__, __version_info__, aes_pad_key, armor, dearmor, pad, unpad
+from .base import (
+    ArmorDecoder,
+    ArmorEncoder,
+    __version__,
+    __version_info__,
+    aes_pad_key,
+    armor,
+    armor_file,
+    armor_headers,
+    dearmor,
+    dearmor_file,
+    pad,
+    unpad,
+)
 
 __all__ = [
+    "ArmorDecoder",
+    "ArmorEncoder",
     "__version__",
     "__version_info__",
     "aes_pad_key",
     "armor",
+    "armor_file",
+    "armor_headers",
     "dearmor",
+    "dearmor_file",
     "pad",
     "unpad",
 ]
@@ -41,7 +59,9 @@ if has_django:
         EncryptedIntegerField,
         EncryptedTextField,
     )
-    from .functions import Decrypt, Encrypt
+    from .functions import Dearmor, Decrypt, Encrypt
+    from .indexes import EncryptedIndex
+    from .query import EncryptedManager, EncryptedQuerySet
 
     __all__ += [
         "EncryptedCharField",
@@ -49,8 +69,12 @@ if has_django:
         "EncryptedDateTimeField",
         "EncryptedDecimalField",
         "EncryptedEmailField",
+        "EncryptedIndex",
         "EncryptedIntegerField",
+        "EncryptedManager",
+        "EncryptedQuerySet",
         "EncryptedTextField",
         "Encrypt",
+        "Dearmor",
         "Decrypt",
     ]
@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+class PgcryptoConfig(AppConfig):
+    name = "pgcrypto"
+
+    def ready(self):
+        if getattr(settings, "PGCRYPTO_EXPLAIN_THRESHOLD", None) is not None:
+            from .diagnostics import install_checker
+
+            connection_created.connect(install_checker)
+        if getattr(settings, "PGCRYPTO_SESSION_KEYS", False):
+            from .session import bind_session_keys
+
+            connection_created.connect(bind_session_keys)
@@ -18,38 +18,123 @@ def ord_safe(ch):
     return ord(ch)
 
 
-def crc24(data):
-    crc = CRC24_INIT
-    for byte in data:
-        crc ^= ord_safe(byte) << 16
+def _crc24_tables(count):
+    """
+    Builds the lookup tables for the table-driven CRC-24. The first table maps each
+    byte value to its CRC contribution, and each subsequent table is the previous
+    one advanced by a zero byte, which is what the sliced variant needs.
+    """
+    table = []
+    for byte in range(256):
+        crc = byte << 16
         for _i in range(8):
             crc <<= 1
             if crc & 0x1000000:
                 crc ^= CRC24_POLY
-    return crc & 0xFFFFFF
+        table.append(crc & 0xFFFFFF)
+    tables = [table]
+    for _i in range(1, count):
+        tables.append(
+            [((crc << 8) & 0xFFFFFF) ^ table[crc >> 16] for crc in tables[-1]]
+        )
+    return tables
+
+
+CRC24_TABLES = _crc24_tables(6)
+# Buffers at least this long are checksummed six bytes at a time.
+CRC24_SLICE_THRESHOLD = 64
+
+
+def crc24_bytewise(data, crc=CRC24_INIT):
+    """
+    Table-driven CRC-24, one byte at a time. Pass the result of a previous call as
+    `crc` to continue a checksum across chunks.
+    """
+    table = CRC24_TABLES[0]
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ byte]
+    return crc
+
+
+def crc24_sliced(data, crc=CRC24_INIT):
+    """
+    Slice-by-6 CRC-24. The first three bytes of each slice are folded into the 24-bit
+    register, and the remaining three only need their (pre-advanced) table entries.
+    Any trailing bytes are handled by crc24_bytewise.
+    """
+    t0, t1, t2, t3, t4, t5 = CRC24_TABLES
+    end = len(data) - (len(data) % 6)
+    for b0, b1, b2, b3, b4, b5 in zip(
+        data[0:end:6],
+        data[1:end:6],
+        data[2:end:6],
+        data[3:end:6],
+        data[4:end:6],
+        data[5:end:6],
+    ):
+        crc = (
+            t5[(crc >> 16) ^ b0]
+            ^ t4[((crc >> 8) & 0xFF) ^ b1]
+            ^ t3[(crc & 0xFF) ^ b2]
+            ^ t2[b3]
+            ^ t1[b4]
+            ^ t0[b5]
+        )
+    return crc24_bytewise(data[end:], crc)
 
 
-def armor(data, versioned=True):
+def crc24(data, crc=CRC24_INIT):
+    """
+    Returns the OpenPGP CRC-24 of the given bytes, bytearray, or memoryview. Strings
+    are checksummed as latin-1, matching the old per-character behavior.
+    """
+    if isinstance(data, str):
+        data = data.encode("latin-1")
+    elif not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    if len(data) >= CRC24_SLICE_THRESHOLD:
+        return crc24_sliced(data, crc)
+    return crc24_bytewise(data, crc)
+
+
+ARMOR_BEGIN = "-----BEGIN PGP MESSAGE-----\n"
+ARMOR_END = "-----END PGP MESSAGE-----"
+# Default read size for armor_file/dearmor_file (a multiple of 3 and 4, so whole
+# base64 groups are produced and consumed on each read).
+ARMOR_CHUNK_SIZE = 3 * 4 * 8192
+
+
+def armor_header(versioned=True, headers=None):
+    """
+    Returns everything in an armored message up to (but not including) the body.
+    """
+    lines = ["Version: django-pgcrypto %s\n" % __version__] if versioned else []
+    if headers:
+        lines.extend("%s: %s\n" % item for item in headers.items())
+    return ARMOR_BEGIN + "".join(lines) + "\n"
+
+
+def armor_footer(crc):
+    """
+    Returns the checksum line and END line of an armored message for the given CRC.
+    """
+    # The 24-bit CRC should be in big-endian, strip off the first byte (it's already
+    # masked in crc24).
+    crc = base64.b64encode(struct.pack(">L", crc)[1:])
+    return "\n=%s\n%s" % (crc.decode("ascii"), ARMOR_END)
+
+
+def armor(data, versioned=True, headers=None):
     """
     Returns a string in ASCII Armor format, for the given binary data. The
     output of this is compatiple with pgcrypto's armor/dearmor functions.
+    Any `headers` (a dict) are written after the Version header.
     """
-    template = (
-        "-----BEGIN PGP MESSAGE-----\n"
-        "%(headers)s%(body)s\n=%(crc)s\n"
-        "-----END PGP MESSAGE-----"
+    return (
+        armor_header(versioned, headers)
+        + base64.b64encode(data).decode("ascii")
+        + armor_footer(crc24(data))
     )
-    body = base64.b64encode(data)
-    # The 24-bit CRC should be in big-endian, strip off the first byte (it's already
-    # masked in crc24).
-    crc = base64.b64encode(struct.pack(">L", crc24(data))[1:])
-    return template % {
-        "headers": "Version: django-pgcrypto %s\n\n" % __version__
-        if versioned
-        else "\n",
-        "body": body.decode("ascii"),
-        "crc": crc.decode("ascii"),
-    }
 
 
 def dearmor(text, verify=True):
@@ -96,6 +181,184 @@ def dearmor(text, verify=True):
     return data
 
 
+def armor_headers(text):
+    """
+    Returns the headers of a string in ASCII Armor format as a dict, without reading
+    any further than the blank line that ends them.
+    """
+    headers = {}
+    begin = text.find("-----BEGIN")
+    if begin < 0:
+        return headers
+    start = text.find("\n", begin) + 1
+    while start:
+        end = text.find("\n", start)
+        line = text[start:end] if end >= 0 else text[start:]
+        if not line.strip() or line.startswith("-----END"):
+            break
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip()] = value.strip()
+        start = end + 1
+    return headers
+
+
+class ArmorEncoder:
+    """
+    Incrementally armors binary data, for values too large to hold in memory twice.
+    Each call to update() returns the next piece of armored text, and finalize()
+    returns the remainder. Concatenated, the pieces are identical to armor(data).
+    """
+
+    def __init__(self, versioned=True, headers=None):
+        self.versioned = versioned
+        self.headers = headers
+        self.crc = CRC24_INIT
+        self.pending = b""
+        self.started = False
+        self.finished = False
+
+    def update(self, data):
+        if self.finished:
+            raise ValueError("ArmorEncoder has already been finalized.")
+        self.crc = crc24(data, self.crc)
+        if self.pending:
+            data = self.pending + bytes(data)
+        # Only encode whole 3-byte groups, so no padding ends up mid-body.
+        end = len(data) - (len(data) % 3)
+        self.pending = bytes(data[end:])
+        text = base64.b64encode(data[:end]).decode("ascii")
+        if not self.started:
+            self.started = True
+            text = armor_header(self.versioned, self.headers) + text
+        return text
+
+    def finalize(self):
+        text = self.update(b"") + base64.b64encode(self.pending).decode("ascii")
+        self.pending = b""
+        self.finished = True
+        return text + armor_footer(self.crc)
+
+
+class ArmorDecoder:
+    """
+    Incrementally dearmors text produced by armor() (or pgcrypto's armor function).
+    Each call to update() returns the binary data decoded so far, and finalize()
+    returns the remainder, checking the CRC if verify=True. Body lines are decoded
+    as they arrive, so a single very long line is never buffered in full.
+    """
+
+    def __init__(self, verify=True):
+        self.verify = verify
+        self.crc = CRC24_INIT
+        self.state = "start"
+        self.partial = ""
+        self.in_data_line = False
+        self.b64 = ""
+        self.check_data = None
+        self.output = []
+
+    def update(self, text):
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode("ascii")
+        pieces = text.split("\n")
+        last = len(pieces) - 1
+        for idx, piece in enumerate(pieces):
+            self._feed(piece, idx < last)
+        data = b"".join(self.output)
+        self.output = []
+        return data
+
+    def finalize(self):
+        if self.partial or self.in_data_line:
+            self._feed("", True)
+        if self.b64:
+            self._decode_body("", final=True)
+        data = b"".join(self.output)
+        self.output = []
+        if self.verify and self.check_data:
+            # The 24-bit CRC is in big-endian, so we add a null byte to the beginning.
+            crc = struct.unpack(">L", b"\0" + base64.b64decode(self.check_data))[0]
+            if crc != self.crc:
+                raise BadChecksumError()
+        return data
+
+    def _feed(self, piece, complete):
+        if self.in_data_line:
+            self._decode_body(piece)
+            self.in_data_line = not complete
+            return
+        line = self.partial + piece
+        if self.state == "body" and line and line[0] not in "=-":
+            # Base64 never starts a line with "=" or "-", so this is body data and
+            # can be decoded without waiting for the rest of the line.
+            self.partial = ""
+            self._decode_body(line)
+            self.in_data_line = not complete
+        elif complete:
+            self.partial = ""
+            self._line(line)
+        else:
+            self.partial = line
+
+    def _line(self, line):
+        if self.state == "start":
+            if line.lstrip().startswith("-----BEGIN"):
+                self.state = "headers"
+            elif line.startswith("-----END"):
+                self.state = "done"
+        elif self.state == "done":
+            pass
+        elif line.startswith("-----END"):
+            self.state = "done"
+        elif self.state == "headers":
+            # Header lines are ignored, and the data starts after an empty line.
+            if not line.strip():
+                self.state = "body"
+        elif line.startswith("="):
+            # Once we get the checksum data, we're done.
+            self.check_data = line[1:5].encode("ascii")
+            self.state = "done"
+
+    def _decode_body(self, chars, final=False):
+        chars = self.b64 + "".join(chars.split())
+        end = len(chars) if final else len(chars) - (len(chars) % 4)
+        self.b64 = chars[end:]
+        if end:
+            data = base64.b64decode(chars[:end].encode("ascii"))
+            self.crc = crc24(data, self.crc)
+            self.output.append(data)
+
+
+def armor_file(src, dst, versioned=True, chunk_size=ARMOR_CHUNK_SIZE):
+    """
+    Reads binary data from the file-like object `src` and writes the armored text to
+    `dst`, holding at most `chunk_size` bytes in memory at a time.
+    """
+    encoder = ArmorEncoder(versioned=versioned)
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(encoder.update(chunk))
+    dst.write(encoder.finalize())
+
+
+def dearmor_file(src, dst, verify=True, chunk_size=ARMOR_CHUNK_SIZE):
+    """
+    Reads armored text from the file-like object `src` and writes the decoded binary
+    data to `dst`. Note that if verify=True and the checksum does not match, the data
+    will already have been written when BadChecksumError is raised.
+    """
+    decoder = ArmorDecoder(verify=verify)
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(decoder.update(chunk))
+    dst.write(decoder.finalize())
+
+
 def unpad(text, block_size):
     """
     Takes the last character of the text, and if it is less than the block_size,
@@ -110,11 +373,25 @@ def unpad(text, block_size):
     if padch > block_size:
         # If the last byte value is larger than the block size, it's not padded.
         return text
+    if isinstance(text, bytes):
+        return text.rstrip(bytes((0, padch)))
     while end > 0 and ord_safe(text[end - 1]) in (0, padch):
         end -= 1
     return text[:end]
 
 
+def unpad_pkcs(data, block_size):
+    """
+    Removes PKCS padding (method 1 above) from a bytestring, raising ValueError if it
+    isn't padded that way. Unlike unpad, trailing bytes of the data itself are never
+    removed, which matters for binary values.
+    """
+    num = data[-1] if data else 0
+    if not 0 < num <= block_size or data[-num:] != bytes((num,)) * num:
+        raise ValueError("Invalid padding")
+    return data[:-num]
+
+
 def pad(text, block_size, zero=False):
     """
     Given a text string and a block size, pads the text with bytes of the same value
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# Returned by LRUCache.get for keys that aren't cached (None is a valid value).
+MISSING = object()
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping that evicts its least recently used entries, and
+    counts hits and misses (see info()). Pickling one (e.g. with a field sent to a
+    worker process) keeps its size, but not its contents.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get(self, key):
+        """
+        Returns the value cached for key, or MISSING.
+        """
+        with self.lock:
+            value = self.data.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Empties the cache, and resets its counters.
+        """
+        with self.lock:
+            self.data = OrderedDict()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+    def __getstate__(self):
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])
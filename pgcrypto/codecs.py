@@ -0,0 +1,131 @@
+import datetime
+import decimal
+import struct
+
+from django.utils.encoding import force_str
+
+from .base import unpad, unpad_pkcs
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class TextCodec:
+    """
+    Encodes values as their text, which is what pgcrypto's decrypt() returns, so they
+    can be decrypted (and cast) in SQL. This is the default codec.
+    """
+
+    name = "text"
+    sql_compatible = True
+
+    def __init__(self, parse, charset="utf-8"):
+        self.parse = parse
+        self.charset = charset
+
+    def unpad(self, data, block_size):
+        return unpad(data, block_size)
+
+    def encode(self, value):
+        return force_str(value).encode(self.charset)
+
+    def decode(self, data):
+        return self.parse(data.decode(self.charset))
+
+
+class BinaryCodec:
+    """
+    Base class for compact, fixed-layout encodings of a field's python type. Values
+    are converted with the field's parser before packing, and unpacked with direct
+    constructors. They can't be decrypted in SQL, so only blind index and
+    deterministic lookups work on them.
+    """
+
+    name = "binary"
+    sql_compatible = False
+
+    def __init__(self, parse):
+        self.parse = parse
+
+    def unpad(self, data, block_size):
+        return unpad_pkcs(data, block_size)
+
+    def encode(self, value):
+        return self.pack(self.parse(value))
+
+    def decode(self, data):
+        return self.unpack(data)
+
+    def pack(self, value):
+        raise NotImplementedError()
+
+    def unpack(self, data):
+        raise NotImplementedError()
+
+
+class IntegerCodec(BinaryCodec):
+    """
+    Big-endian two's complement, in as few bytes as the value needs.
+    """
+
+    def pack(self, value):
+        return value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+
+    def unpack(self, data):
+        return int.from_bytes(data, "big", signed=True)
+
+
+class DecimalCodec(IntegerCodec):
+    """
+    A signed exponent byte, followed by the coefficient as an IntegerCodec value.
+    """
+
+    def pack(self, value):
+        sign, digits, exponent = value.as_tuple()
+        if not isinstance(exponent, int) or not -128 <= exponent <= 127:
+            raise ValueError("Cannot encode {!r} in binary".format(value))
+        coefficient = int("".join(map(str, digits)))
+        return struct.pack(">b", exponent) + super().pack(
+            -coefficient if sign else coefficient
+        )
+
+    def unpack(self, data):
+        coefficient = super().unpack(data[1:])
+        return decimal.Decimal(
+            (
+                int(coefficient < 0),
+                tuple(map(int, str(abs(coefficient)))),
+                struct.unpack(">b", data[:1])[0],
+            )
+        )
+
+
+class DateCodec(BinaryCodec):
+    """
+    The proleptic Gregorian ordinal, in 3 bytes.
+    """
+
+    def pack(self, value):
+        return value.toordinal().to_bytes(3, "big")
+
+    def unpack(self, data):
+        return datetime.date.fromordinal(int.from_bytes(data, "big"))
+
+
+class DateTimeCodec(BinaryCodec):
+    """
+    A flag byte (1 for aware, 0 for naive), followed by the microseconds since the
+    Unix epoch (in UTC, for aware values) as a signed 8 byte integer. Aware values
+    are decoded in UTC.
+    """
+
+    def pack(self, value):
+        aware = value.tzinfo is not None
+        if aware:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return struct.pack(">?q", aware, (value - EPOCH) // MICROSECOND)
+
+    def unpack(self, data):
+        aware, micros = struct.unpack(">?q", data)
+        value = EPOCH + datetime.timedelta(microseconds=micros)
+        return value.replace(tzinfo=datetime.timezone.utc) if aware else value
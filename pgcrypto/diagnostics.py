@@ -0,0 +1,234 @@
+import json
+import re
+import warnings
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+
+from .fields import BaseEncryptedField
+
+# What is reported for each decrypt() (or pgcrypto_decrypt*()) call in a query plan:
+# the field decrypted, the plan node it's evaluated in (e.g. "Seq Scan on
+# testapp_employee"), the condition it's part of (with any keys left out), how many
+# rows it decrypts (estimated, or counted with analyze=True), and whether the
+# decrypted values come from an index (see EncryptedIndex) instead.
+EncryptedPredicate = namedtuple(
+    "EncryptedPredicate", ["field", "node", "condition", "rows", "indexed"]
+)
+
+# The plan node properties holding conditions, and whether each one is answered
+# by an index.
+CONDITIONS = {
+    "Index Cond": True,
+    "Recheck Cond": True,
+    "Filter": False,
+    "Join Filter": False,
+    "Hash Cond": False,
+    "Merge Cond": False,
+}
+
+DECRYPT_RE = re.compile(
+    r"\b(?:pgcrypto_decrypt\w*|decrypt)\((?:dearmor\()?(?:NULLIF\()?"
+    r'(?:"?\w+"?\.)?"?(\w+)"?'
+)
+BYTEA_RE = re.compile(r"'\\\\?x[0-9a-f]*'::bytea")
+
+ACTIONS = ("warn", "raise")
+
+
+class ExpensiveDecryptionWarning(UserWarning):
+    pass
+
+
+class ExpensiveDecryptionError(Exception):
+    pass
+
+
+def encrypted_columns():
+    """
+    Returns {(table, column): field} for the encrypted fields of every model.
+    """
+    return {
+        (model._meta.db_table, field.column): field
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, BaseEncryptedField)
+    }
+
+
+def explain(queryset, analyze=False):
+    """
+    Runs EXPLAIN (or with analyze=True, EXPLAIN ANALYZE, which runs the query) on a
+    queryset, and returns an EncryptedPredicate for each value it decrypts in SQL.
+    Without analyze, scans of a whole table are estimated to decrypt every row of
+    it (by the table's statistics), other plan nodes their estimated row count.
+    """
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    sql, params = compiler.as_sql()
+    options = "FORMAT JSON, ANALYZE" if analyze else "FORMAT JSON"
+    with compiler.connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (%s) %s" % (options, sql), params)
+        plan = cursor.fetchone()[0]
+        return analyze_plan(
+            json.loads(plan) if isinstance(plan, str) else plan,
+            lambda table: table_rows(cursor, table),
+        )
+
+
+def table_rows(cursor, table):
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [table])
+    row = cursor.fetchone()
+    return row[0] if row else -1
+
+
+def analyze_plan(plan, table_rows):
+    """
+    Returns the EncryptedPredicates of a plan in EXPLAIN's JSON format, using
+    table_rows(table) for the estimated size of a table.
+    """
+    columns = encrypted_columns()
+    predicates = []
+
+    def walk(node, loops):
+        children = node.get("Plans", [])
+        for key, indexed in CONDITIONS.items():
+            condition = node.get(key)
+            if not condition:
+                continue
+            for column in DECRYPT_RE.findall(condition):
+                relation = node.get("Relation Name")
+                field = columns.get((relation, column))
+                predicates.append(
+                    EncryptedPredicate(
+                        str(field) if field else column,
+                        "%s on %s" % (node["Node Type"], relation)
+                        if relation
+                        else node["Node Type"],
+                        BYTEA_RE.sub("'...'::bytea", condition),
+                        0 if indexed else node_rows(node, key, loops, table_rows),
+                        indexed,
+                    )
+                )
+        for child in children:
+            child_loops = loops
+            if node["Node Type"] == "Nested Loop" and (
+                child.get("Parent Relationship") == "Inner"
+            ):
+                # The inner side runs once per row of the outer side.
+                child_loops = loops * children[0].get("Plan Rows", 1)
+            walk(child, child_loops)
+
+    for item in plan:
+        walk(item["Plan"], 1)
+    return predicates
+
+
+def node_rows(node, key, loops, table_rows):
+    """
+    Returns the number of rows a plan node evaluates its `key` condition on.
+    """
+    if "Actual Rows" in node:
+        removed = node.get("Rows Removed by %s" % key, 0)
+        return int((node["Actual Rows"] + removed) * node.get("Actual Loops", 1))
+    rows = node.get("Plan Rows", 0)
+    if node["Node Type"] in ("Seq Scan", "Parallel Seq Scan") and key == "Filter":
+        rows = max(rows, table_rows(node["Relation Name"]))
+    return int(rows * loops)
+
+
+def get_threshold(threshold=None):
+    if threshold is None:
+        return getattr(settings, "PGCRYPTO_EXPLAIN_THRESHOLD", None)
+    return threshold
+
+
+def get_action(action=None):
+    if action is None:
+        action = getattr(settings, "PGCRYPTO_EXPLAIN_ACTION", "warn")
+    if action not in ACTIONS:
+        raise ValueError(
+            "PGCRYPTO_EXPLAIN_ACTION must be one of: %s" % ", ".join(ACTIONS)
+        )
+    return action
+
+
+def report(predicates, threshold, action):
+    """
+    Warns about (or raises for) the predicates that decrypt more than `threshold`
+    rows, and returns them.
+    """
+    expensive = [p for p in predicates if p.rows > threshold]
+    if expensive:
+        message = "Encrypted filters decrypt more than %d rows: %s" % (
+            threshold,
+            "; ".join(
+                "%s (%d rows, %s)" % (p.field, p.rows, p.node) for p in expensive
+            ),
+        )
+        if action == "raise":
+            raise ExpensiveDecryptionError(message)
+        warnings.warn(message, ExpensiveDecryptionWarning, stacklevel=3)
+    return expensive
+
+
+def check(queryset, threshold=None, action=None, analyze=False):
+    """
+    Explains a queryset (see explain), and warns or raises (see
+    PGCRYPTO_EXPLAIN_ACTION) if any of its encrypted predicates decrypts more than
+    `threshold` rows (default: PGCRYPTO_EXPLAIN_THRESHOLD). Returns the predicates.
+    """
+    threshold = get_threshold(threshold)
+    action = get_action(action)
+    predicates = explain(queryset, analyze=analyze)
+    if threshold is not None:
+        report(predicates, threshold, action)
+    return predicates
+
+
+class QueryChecker:
+    """
+    A database execute wrapper (see connection.execute_wrapper) that explains each
+    query decrypting values in SQL before running it, and warns or raises if it's
+    estimated to decrypt more than `threshold` rows. See check().
+    """
+
+    def __init__(self, threshold=None, action=None):
+        self.threshold = get_threshold(threshold)
+        self.action = get_action(action)
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and "decrypt(" in sql and sql.lstrip().startswith("SELECT"):
+            # Explain with the underlying cursor, so it isn't run through the
+            # connection's execute wrappers or logged as a query.
+            with context["connection"].connection.cursor() as cursor:
+                cursor.execute("EXPLAIN (FORMAT JSON) %s" % sql, params)
+                plan = cursor.fetchone()[0]
+                predicates = analyze_plan(
+                    json.loads(plan) if isinstance(plan, str) else plan,
+                    lambda table: table_rows(cursor, table),
+                )
+            report(predicates, self.threshold, self.action)
+        return execute(sql, params, many, context)
+
+
+def is_checking():
+    """
+    Whether queries are checked as they run: only with DEBUG on, or with
+    PGCRYPTO_EXPLAIN_QUERIES = True (e.g. for test runs, which turn DEBUG off), so
+    that a threshold left set in production doesn't add an EXPLAIN to every query.
+    """
+    return get_threshold() is not None and (
+        settings.DEBUG or getattr(settings, "PGCRYPTO_EXPLAIN_QUERIES", False)
+    )
+
+
+def install_checker(connection, **kwargs):
+    """
+    A connection_created receiver that adds a QueryChecker to new connections, when
+    PGCRYPTO_EXPLAIN_THRESHOLD is set (see PgcryptoConfig.ready and is_checking).
+    """
+    if connection.vendor != "postgresql" or not is_checking():
+        return
+    if not any(isinstance(w, QueryChecker) for w in connection.execute_wrappers):
+        connection.execute_wrappers.append(QueryChecker())
@@ -1,25 +1,103 @@
 import datetime
 import decimal
+import hashlib
+import hmac
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from django import forms
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
 from django.core import validators
-from django.db import models
+from django.db import NotSupportedError, models
+from django.db.models.expressions import Col
 from django.db.models.lookups import FieldGetDbPrepValueIterableMixin, Lookup
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import post_save
 from django.utils import timezone
 from django.utils.encoding import force_str
 from django.utils.translation import gettext_lazy as _
 
-from .base import aes_pad_key, armor, dearmor, pad, unpad
+from . import codecs
+from .base import aes_pad_key, armor, armor_headers, dearmor, pad
+from .cache import MISSING, LRUCache
+from .session import key_sql
+
+CIPHERS = {
+    "aes": algorithms.AES,
+}
+
+# How ciphertext is stored: ASCII armored in a text column, or raw in a bytea column.
+STORAGES = ("text", "bytea")
+# The armor header naming the keyring key a value was encrypted with.
+KEY_ID_HEADER = "Key-ID"
+# Instance attribute holding the {attname: (armored, decrypted)} values of lazy fields
+# that have been read.
+LAZY_VALUES = "_pgcrypto_lazy_values"
+# Instance attribute holding {attname: (plaintext, stored)} for values that
+# EncryptedQuerySet's bulk methods have encrypted ahead of saving.
+PREPARED_VALUES = "_pgcrypto_prepared_values"
+# Mark the start and end of values split into n-grams for a token index, so that
+# startswith and endswith patterns only match n-grams at the ends.
+TOKEN_START = "\x02"
+TOKEN_END = "\x03"
+# Hex digits kept from each token's HMAC. Collisions only add candidates, which the
+# decrypted comparison then rules out.
+TOKEN_LENGTH = 16
+
+
+class LazyDecryptAttribute(DeferredAttribute):
+    """
+    The attribute for fields with lazy=True. The armored value loaded from the
+    database is only decrypted when it is first read, and the result is kept on the
+    instance, along with the armored value so that saving it unchanged writes the
+    same ciphertext back.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        field = self.field
+        if field.is_encrypted(value):
+            decrypted = field.to_python(value)
+            instance.__dict__[field.attname] = decrypted
+            instance.__dict__.setdefault(LAZY_VALUES, {})[field.attname] = (
+                value,
+                decrypted,
+            )
+            return decrypted
+        return value
+
+    def __set__(self, instance, value):
+        # Being a data descriptor means __get__ is called even once the value is in
+        # the instance's __dict__.
+        instance.__dict__[self.field.attname] = value
 
 
 class BaseEncryptedField(models.Field):
     field_cast = ""
+    # The unencrypted field type of values decrypted (and cast) in SQL.
+    plain_field = models.TextField
     coalesce = None
+    decrypt_function = "pgcrypto_decrypt"
+    binary_codec = None
+    decrypt_cache = None
+    encrypt_cache = None
 
     def __init__(self, *args, **kwargs):
+        decrypt_cache_size = kwargs.pop(
+            "decrypt_cache_size",
+            getattr(settings, "PGCRYPTO_DECRYPT_CACHE_SIZE", None),
+        )
+        if decrypt_cache_size:
+            self.decrypt_cache = LRUCache(decrypt_cache_size)
+        encrypt_cache_size = kwargs.pop(
+            "encrypt_cache_size",
+            getattr(settings, "PGCRYPTO_ENCRYPT_CACHE_SIZE", None),
+        )
+        if encrypt_cache_size:
+            self.encrypt_cache = LRUCache(encrypt_cache_size)
         self.cipher_name = kwargs.pop(
             "cipher", getattr(settings, "PGCRYPTO_DEFAULT_CIPHER", "aes")
         ).lower()
@@ -33,11 +111,65 @@ class BaseEncryptedField(models.Field):
             self.cipher_key = self.cipher_key.encode(self.charset)
         if self.cipher_name == "aes":
             self.cipher_key = aes_pad_key(self.cipher_key)
+        self.storage = kwargs.pop("storage", "text")
+        if self.storage not in STORAGES:
+            raise ValueError(
+                "Storage must be `text` or `bytea` (got `{}`)".format(self.storage)
+            )
+        codec = kwargs.pop("codec", "text")
+        if codec == "text":
+            self.codec = codecs.TextCodec(self._parse_value, self.charset)
+        elif codec == "binary" and self.binary_codec is not None:
+            self.codec = self.binary_codec(self._parse_value)
+        else:
+            raise ValueError(
+                "{} has no `{}` codec".format(self.__class__.__name__, codec)
+            )
+        self.indexable = kwargs.pop("indexable", False)
+        if self.indexable and not self.codec.sql_compatible:
+            raise ValueError("Only fields with the text codec can be indexable")
+        if self.indexable and self.decrypt_function is None:
+            raise ValueError("{} can't be indexable".format(self.__class__.__name__))
         self.check_armor = kwargs.pop("check_armor", True)
         self.versioned = kwargs.pop("versioned", False)
+        keyring = kwargs.pop("keyring", getattr(settings, "PGCRYPTO_KEYRING", None))
+        self.deterministic_lookups = kwargs.pop("deterministic_lookups", False)
+        if self.deterministic_lookups and self.plain_field is not models.TextField:
+            # Equal numbers, dates and times can be written (and encrypted) in more
+            # than one way, so only text compares exactly as ciphertext.
+            raise ValueError("Only text fields can have deterministic lookups")
+        self.lazy = kwargs.pop("lazy", False)
+        if self.lazy:
+            self.descriptor_class = LazyDecryptAttribute
+        self.blind_index = kwargs.pop("blind_index", False)
+        self.blind_index_key = kwargs.pop(
+            "blind_index_key", getattr(settings, "PGCRYPTO_BLIND_INDEX_KEY", None)
+        )
+        if isinstance(self.blind_index_key, str):
+            self.blind_index_key = self.blind_index_key.encode(self.charset)
+        self.token_index = kwargs.pop("token_index", False)
+        self.token_size = kwargs.pop("token_size", 3)
+        if self.token_index and self.plain_field is not models.TextField:
+            raise ValueError("Only text fields can have a token index")
+        if self.token_size < 1:
+            raise ValueError("token_size must be at least 1")
+        self.algorithm = CIPHERS[self.cipher_name]
+        self.block_size = self.algorithm.block_size // 8
+        # Key IDs are only written to versioned armor, so unversioned (and bytea)
+        # fields ignore the keyring. New values use the first key, and values without
+        # a Key-ID header are still decrypted with cipher_key.
+        self.keyring = {}
+        if keyring and self.versioned and self.storage == "text":
+            for key_id, key in keyring.items():
+                if isinstance(key, str):
+                    key = key.encode(self.charset)
+                self.keyring[str(key_id)] = aes_pad_key(key)
+        self.key_id = next(iter(self.keyring), None)
         super().__init__(*args, **kwargs)
 
     def get_internal_type(self):
+        if self.storage == "bytea":
+            return "BinaryField"
         return "TextField"
 
     def deconstruct(self):
@@ -53,42 +185,311 @@ class BaseEncryptedField(models.Field):
                 "versioned": self.versioned,
             }
         )
+        if self.deterministic_lookups:
+            kwargs["deterministic_lookups"] = True
+        if self.indexable:
+            kwargs["indexable"] = True
+        if self.lazy:
+            kwargs["lazy"] = True
+        if self.storage != "text":
+            kwargs["storage"] = self.storage
+        if self.codec.name != "text":
+            kwargs["codec"] = self.codec.name
+        if self.blind_index:
+            kwargs["blind_index"] = self.blind_index
+        if self.token_index:
+            kwargs["token_index"] = self.token_index
+            kwargs["token_size"] = self.token_size
         return name, path, args, kwargs
 
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super().contribute_to_class(cls, name, *args, **kwargs)
+        if self.blind_index:
+            BlindIndexField(source=name).contribute_to_class(cls, self.blind_index_name)
+        if self.token_index:
+            TokenIndexField(source=name).contribute_to_class(cls, self.token_index_name)
+
     @property
-    def algorithm(self):
-        return {"aes": algorithms.AES}[self.cipher_name]
+    def blind_index_name(self):
+        if isinstance(self.blind_index, str):
+            return self.blind_index
+        return "%s_bidx" % self.name
 
     @property
-    def block_size(self):
-        return self.algorithm.block_size // 8
+    def blind_index_field(self):
+        return self.model._meta.get_field(self.blind_index_name)
 
-    def get_cipher(self):
+    def get_blind_index(self, value):
         """
-        Return a new Cipher object for each time we want to encrypt/decrypt. This is
-        because pgcrypto expects a zeroed block for IV (initial value), but the IV on
-        the cipher object is cumulatively updated each time encrypt/decrypt is called.
+        Returns the keyed HMAC stored in the blind index column for the given value
+        (which may be armored), or None for empty values. Values are normalized with
+        to_python first, so anything that saves the same value hashes the same.
         """
-        return Cipher(
-            self.algorithm(self.cipher_key),
-            modes.CBC(b"\0" * self.block_size),
-            backend=default_backend(),
-        )
+        value = self.to_python(value)
+        if value is None or value == "":
+            return None
+        key = self.blind_index_key
+        if key is None:
+            # Don't use the encryption key directly as the HMAC key.
+            key = hmac.new(
+                self.cipher_key, b"django-pgcrypto blind index", hashlib.sha256
+            ).digest()
+        text = self._blind_index_text(value).encode(self.charset)
+        return hmac.new(key, text, hashlib.sha256).hexdigest()
+
+    def _blind_index_text(self, value):
+        return force_str(value)
 
-    def encrypt(self, data):
-        context = self.get_cipher().encryptor()
+    @property
+    def token_index_name(self):
+        if isinstance(self.token_index, str):
+            return self.token_index
+        return "%s_tokens" % self.name
+
+    @property
+    def token_index_field(self):
+        return self.model._meta.get_field(self.token_index_name)
+
+    def get_tokens(self, value):
+        """
+        Returns the sorted tokens stored in the token index column for the given value
+        (which may be armored), or None for empty values: keyed HMACs of each n-gram
+        of the uppercased value (marked at its start and end), and of each of its
+        prefixes too short to be an n-gram. Uppercasing maps each character on its own,
+        as the UPPER() that case-insensitive lookups compare with does, so a pattern's
+        n-grams are always among those of a value matching it.
+        """
+        value = self.to_python(value)
+        if value is None or value == "":
+            return None
+        text = TOKEN_START + force_str(value).upper() + TOKEN_END
+        grams = set(self.ngrams(text))
+        grams.update(text[:size] for size in range(2, min(self.token_size, len(text))))
+        return sorted(self.hash_tokens(grams))
+
+    def get_search_tokens(self, pattern, lookup_name):
+        """
+        Returns the tokens that every value matching a contains, startswith or endswith
+        lookup (or their case-insensitive versions) on `pattern` has, or an empty list
+        if the pattern is too short to narrow the search.
+        """
+        text = force_str(pattern).upper()
+        if lookup_name.endswith("startswith"):
+            text = TOKEN_START + text
+        elif lookup_name.endswith("endswith"):
+            text += TOKEN_END
+        if len(text) >= self.token_size:
+            return sorted(self.hash_tokens(set(self.ngrams(text))))
+        if text.startswith(TOKEN_START) and len(text) > 1:
+            return self.hash_tokens([text])
+        return []
+
+    def ngrams(self, text):
+        size = self.token_size
+        if len(text) <= size:
+            return [text]
+        return [text[i : i + size] for i in range(len(text) - size + 1)]
+
+    def hash_tokens(self, grams):
+        # Not the blind index key itself, so tokens can't be compared with it.
+        key = hmac.new(
+            self.blind_index_key or self.cipher_key,
+            b"django-pgcrypto token index",
+            hashlib.sha256,
+        ).digest()
+        hashes = (hmac.new(key, g.encode(self.charset), hashlib.sha256) for g in grams)
+        return [h.hexdigest()[:TOKEN_LENGTH] for h in hashes]
+
+    @property
+    def cipher_key(self):
+        return self._cipher_key
+
+    @cipher_key.setter
+    def cipher_key(self, key):
+        # Changing the key invalidates the cached Ciphers (and values).
+        self._cipher_key = key
+        self._ciphers = {}
+        self._block_ciphers = {}
+        if self.decrypt_cache is not None:
+            self.decrypt_cache.clear()
+        if self.encrypt_cache is not None:
+            self.encrypt_cache.clear()
+
+    def cache_info(self):
+        """
+        Returns the (hits, misses, maxsize, currsize) of the decrypted value cache
+        (see decrypt_cache_size), or None if the field doesn't have one.
+        """
+        if self.decrypt_cache is None:
+            return None
+        return self.decrypt_cache.info()
+
+    def encrypt_cache_info(self):
+        """
+        Returns the (hits, misses, maxsize, currsize) of the encrypted value cache
+        (see encrypt_cache_size), or None if the field doesn't have one.
+        """
+        if self.encrypt_cache is None:
+            return None
+        return self.encrypt_cache.info()
+
+    @property
+    def active_key(self):
+        """
+        The key new values are encrypted with: the first keyring key, if there is a
+        keyring, otherwise cipher_key.
+        """
+        if self.key_id is None:
+            return self.cipher_key
+        return self.keyring[self.key_id]
+
+    def get_key(self, key_id=None):
+        """
+        Returns the keyring key with the given ID, or cipher_key for None.
+        """
+        if key_id is None:
+            return self.cipher_key
+        try:
+            return self.keyring[key_id]
+        except KeyError:
+            raise ValueError("Unknown key ID `{}`".format(key_id))
+
+    def get_value_key(self, value):
+        """
+        Returns the key to decrypt the given armored value with, according to its
+        Key-ID header.
+        """
+        if not self.keyring:
+            return self.cipher_key
+        return self.get_key(armor_headers(value).get(KEY_ID_HEADER))
+
+    def get_keys(self):
+        """
+        Returns every key a stored value may have been encrypted with.
+        """
+        keys = [self.cipher_key]
+        keys.extend(key for key in self.keyring.values() if key not in keys)
+        return keys
+
+    def get_cipher(self, key=None):
+        """
+        Return the Cipher for the given key (by default, active_key), building it on
+        first use. The Cipher itself holds no state between operations: each
+        encryptor()/decryptor() it creates starts from the zeroed block pgcrypto
+        expects for the IV, so only those per-operation contexts need to be created
+        for each value.
+        """
+        key = key or self.active_key
+        cipher = self._ciphers.get(key)
+        if cipher is None:
+            cipher = self._ciphers[key] = Cipher(
+                self.algorithm(key),
+                modes.CBC(b"\0" * self.block_size),
+                backend=default_backend(),
+            )
+        return cipher
+
+    def get_block_cipher(self, key=None):
+        """
+        Return an ECB Cipher for the given key (by default, active_key), used to
+        encrypt or decrypt many values in a single call (see encrypt_many and
+        decrypt_many).
+        """
+        key = key or self.active_key
+        cipher = self._block_ciphers.get(key)
+        if cipher is None:
+            cipher = self._block_ciphers[key] = Cipher(
+                self.algorithm(key), modes.ECB(), backend=default_backend()
+            )
+        return cipher
+
+    def encrypt(self, data, key=None):
+        context = self.get_cipher(key).encryptor()
         return context.update(data) + context.finalize()
 
-    def decrypt(self, data):
-        context = self.get_cipher().decryptor()
+    def decrypt(self, data, key=None):
+        context = self.get_cipher(key).decryptor()
         return context.update(data) + context.finalize()
 
+    def decrypt_many(self, values, key=None):
+        """
+        Decrypts a list of ciphertexts, returning a list of (still padded) plaintexts.
+        Every value is decrypted with the same zeroed IV, so instead of a CBC context
+        per value, all the blocks go through one ECB call and are then XORed with the
+        preceding ciphertext block (or the zero IV, for the first block of a value).
+        """
+        size = self.block_size
+        if any(len(data) % size for data in values):
+            # Let the CBC context raise the appropriate error.
+            return [self.decrypt(data, key) for data in values]
+        iv = b"\0" * size
+        joined = b"".join(values)
+        previous = b"".join(iv + data[:-size] for data in values if data)
+        context = self.get_block_cipher(key).decryptor()
+        decrypted = context.update(joined) + context.finalize()
+        plaintext = (
+            int.from_bytes(decrypted, "big") ^ int.from_bytes(previous, "big")
+        ).to_bytes(len(joined), "big")
+        results = []
+        start = 0
+        for data in values:
+            results.append(plaintext[start : start + len(data)])
+            start += len(data)
+        return results
+
+    def encrypt_many(self, values, key=None):
+        """
+        Encrypts a list of padded plaintexts, returning a list of ciphertexts. As in
+        decrypt_many, every value uses the same zeroed IV, so instead of a CBC context
+        per value, the values are chained a block position at a time: the n-th blocks
+        of every value are XORed with their preceding ciphertext blocks (or the zero
+        IV) and go through one ECB call together.
+        """
+        size = self.block_size
+        if any(len(data) % size for data in values):
+            # Let the CBC context raise the appropriate error.
+            return [self.encrypt(data, key) for data in values]
+        results = [[] for _data in values]
+        previous = [b"\0" * size] * len(values)
+        active = range(len(values))
+        context = self.get_block_cipher(key).encryptor()
+        start = 0
+        while True:
+            active = [idx for idx in active if len(values[idx]) > start]
+            if not active:
+                break
+            blocks = b"".join(values[idx][start : start + size] for idx in active)
+            chained = b"".join(previous[idx] for idx in active)
+            encrypted = context.update(
+                (
+                    int.from_bytes(blocks, "big") ^ int.from_bytes(chained, "big")
+                ).to_bytes(len(blocks), "big")
+            )
+            for pos, idx in enumerate(active):
+                block = encrypted[pos * size : (pos + 1) * size]
+                results[idx].append(block)
+                previous[idx] = block
+            start += size
+        context.finalize()
+        return [b"".join(blocks) for blocks in results]
+
     def is_encrypted(self, value):
         """
-        Returns whether the given value is encrypted (and armored) or not.
+        Returns whether the given value is encrypted (and armored, for text storage)
+        or not.
         """
+        if self.storage == "bytea":
+            return isinstance(value, (bytes, bytearray, memoryview)) and len(value) > 0
         return isinstance(value, str) and value.startswith("-----BEGIN")
 
+    def decode_ciphertext(self, value):
+        """
+        Returns the raw ciphertext of a stored (encrypted) value.
+        """
+        if self.storage == "bytea":
+            return bytes(value)
+        return dearmor(value, verify=self.check_armor)
+
     def to_python(self, value):
         if self.is_encrypted(value):
             # If we have an encrypted (armored, really) value, do the following when
@@ -96,15 +497,114 @@ class BaseEncryptedField(models.Field):
             #    1. De-armor the value to get an encrypted bytestring.
             #    2. Decrypt the bytestring using the specified cipher.
             #    3. Unpad the bytestring using the cipher's block size.
-            #    4. Decode to a unicode string using the specified charset.
-            return unpad(
-                self.decrypt(dearmor(value, verify=self.check_armor)), self.block_size
-            ).decode(self.charset)
+            #    4. Decode it using the field's codec (by default, as a unicode string
+            #       in the specified charset).
+            if self.decrypt_cache is not None:
+                return self.from_db_values([value])[0]
+            data = self.decode_ciphertext(value)
+            return self.decode_value(self.decrypt(data, self.get_value_key(value)))
         return value
 
     def from_db_value(self, value, expression, connection):
+        if self.storage == "bytea" and value is not None and not len(value):
+            value = ""
+        if self.lazy:
+            # Decrypted by LazyDecryptAttribute when the attribute is read.
+            return value
         return self.to_python(value)
 
+    def from_db_values(self, values):
+        """
+        Converts a batch of database values, returning the same results as calling
+        from_db_value on each one. All the armored values are decrypted together (see
+        decrypt_many), which avoids most of the per-value overhead, and with a decrypt
+        cache (decrypt_cache_size), only those that aren't cached are.
+        """
+        if self.decrypt_cache is None:
+            return self._from_db_values(values)
+        # Every value is encrypted with a zeroed IV, so equal plaintexts are stored
+        # identically, and repeated stored values only need decrypting once.
+        results = list(values)
+        misses = {}
+        for idx, value in enumerate(results):
+            if isinstance(value, memoryview):
+                value = bytes(value)
+            cached = (
+                self.decrypt_cache.get(value) if self.is_encrypted(value) else MISSING
+            )
+            if cached is MISSING:
+                misses.setdefault(value, []).append(idx)
+            else:
+                results[idx] = cached
+        for (value, positions), result in zip(
+            misses.items(), self._from_db_values(list(misses))
+        ):
+            if self.is_encrypted(value):
+                self.decrypt_cache.set(value, result)
+            for idx in positions:
+                results[idx] = result
+        return results
+
+    def _from_db_values(self, values):
+        results = list(values)
+        # Positions and ciphertexts of the values encrypted with each key.
+        groups = {}
+        for idx, value in enumerate(results):
+            if self.is_encrypted(value):
+                positions, ciphertexts = groups.setdefault(
+                    self.get_value_key(value), ([], [])
+                )
+                positions.append(idx)
+                ciphertexts.append(self.decode_ciphertext(value))
+            elif self.storage == "bytea" and value is not None and not len(value):
+                results[idx] = ""
+            else:
+                results[idx] = self.to_python(value)
+        for key, (positions, ciphertexts) in groups.items():
+            for idx, data in zip(positions, self.decrypt_many(ciphertexts, key)):
+                results[idx] = self.decode_value(data)
+        return results
+
+    def _parse_value(self, value):
+        """
+        Converts a decrypted string into the field's python type.
+        """
+        return value
+
+    def encode_value(self, value):
+        """
+        Returns the padded plaintext bytes to encrypt for the given python value.
+        """
+        return pad(self.codec.encode(value), self.block_size)
+
+    def decode_value(self, data):
+        """
+        Returns the python value of decrypted (still padded) plaintext bytes.
+        """
+        return self.codec.decode(self.codec.unpad(data, self.block_size))
+
+    def pre_save(self, model_instance, add):
+        if self.lazy and self.attname in model_instance.__dict__:
+            # Read the stored value directly, so an unread value isn't decrypted just
+            # to be encrypted again.
+            value = model_instance.__dict__[self.attname]
+            armored, decrypted = model_instance.__dict__.get(LAZY_VALUES, {}).get(
+                self.attname, (None, None)
+            )
+            if armored is not None and value == decrypted:
+                value = armored
+            if not self.is_encrypted(value) or self.is_active_key(value):
+                return value
+        return super().pre_save(model_instance, add)
+
+    def is_active_key(self, value):
+        """
+        Returns whether the given armored value is encrypted with active_key.
+        """
+        if self.key_id is None:
+            return True
+        return armor_headers(value).get(KEY_ID_HEADER) == self.key_id
+
     def get_db_prep_save(self, value, connection):
         if hasattr(value, "as_sql"):
             # If the value is a query expression do not encrypt it, it will circle back to this function to
@@ -115,18 +615,142 @@ class BaseEncryptedField(models.Field):
             # If we have a value and it's not encrypted, do the following before storing
             # in the database:
             #    1. Convert it to a unicode string (by calling unicode).
-            #    2. Encode the unicode string according to the specified charset.
+            #    2. Encode the unicode string according to the specified charset (or
+            #       use the field's binary codec).
             #    3. Pad the bytestring for encryption, using the cipher's block size.
             #    4. Encrypt the padded bytestring using the specified cipher.
             #    5. Armor the encrypted bytestring for storage in the text field.
-            return armor(
-                self.encrypt(
-                    pad(force_str(value).encode(self.charset), self.block_size)
-                ),
-                versioned=self.versioned,
-            )
+            return self.get_stored_value(value)
+        if value == "" and self.storage == "bytea":
+            return b""
         return value
 
+    def get_db_prep_save_many(self, values, connection=None):
+        """
+        Prepares a batch of values for saving, returning the same results as calling
+        get_db_prep_save on each one. All the values that need encrypting are
+        encrypted together (see encrypt_many).
+        """
+        results = list(values)
+        positions = []
+        for idx, value in enumerate(results):
+            if hasattr(value, "as_sql") or not value or self.is_encrypted(value):
+                results[idx] = self.get_db_prep_save(value, connection)
+            else:
+                positions.append(idx)
+        plaintexts = [self.encode_value(results[idx]) for idx in positions]
+        if self.encrypt_cache is not None:
+            misses = []
+            for idx, data in zip(positions, plaintexts):
+                stored = self.encrypt_cache.get((self.active_key, data, True))
+                if stored is MISSING:
+                    misses.append((idx, data))
+                else:
+                    results[idx] = stored
+            positions = [idx for idx, _data in misses]
+            plaintexts = [data for _idx, data in misses]
+        ciphertexts = self.encrypt_many(plaintexts)
+        for idx, data, ciphertext in zip(positions, plaintexts, ciphertexts):
+            results[idx] = self.encode_ciphertext(ciphertext)
+            if self.encrypt_cache is not None:
+                self.encrypt_cache.set((self.active_key, data, True), results[idx])
+        return results
+
+    def get_ciphertext(self, value, key=None):
+        """
+        Returns the raw (unarmored) ciphertext stored for the given python value.
+        """
+        data = self.encode_value(value)
+        if self.encrypt_cache is None:
+            return self.encrypt(data, key)
+        return self.encrypt_cached(data, key or self.active_key, stored=False)
+
+    def get_stored_value(self, value):
+        """
+        Returns what is stored for the given python value: its ciphertext, armored
+        for text storage.
+        """
+        if self.encrypt_cache is None:
+            return self.encode_ciphertext(self.get_ciphertext(value))
+        return self.encrypt_cached(
+            self.encode_value(value), self.active_key, stored=True
+        )
+
+    def encrypt_cached(self, data, key, stored):
+        """
+        Encrypts padded plaintext (and prepares it for storage if stored=True, which
+        requires key to be active_key) through the encrypt cache. Encryption is
+        deterministic, so a given key and plaintext always give the same result.
+        """
+        cache_key = (key, data, stored)
+        result = self.encrypt_cache.get(cache_key)
+        if result is MISSING:
+            result = self.encrypt(data, key)
+            if stored:
+                result = self.encode_ciphertext(result)
+            self.encrypt_cache.set(cache_key, result)
+        return result
+
+    def encode_ciphertext(self, data):
+        """
+        Prepares ciphertext encrypted with active_key for storage. For text storage,
+        it is armored, naming the key in a Key-ID header if there is a keyring.
+        """
+        if self.storage == "bytea":
+            return data
+        headers = None if self.key_id is None else {KEY_ID_HEADER: self.key_id}
+        return armor(data, versioned=self.versioned, headers=headers)
+
+    def get_ciphertext_sql(self, sql):
+        """
+        Returns SQL for the raw ciphertext of the column `sql`, or NULL if it's blank.
+        """
+        if self.storage == "bytea":
+            return "nullif(%s, ''::bytea)" % sql
+        return "dearmor(nullif(%s, ''))" % sql
+
+    def get_key_sql(self, sql, params=(), connection=None):
+        """
+        Returns SQL (and its params) for the key to decrypt the armored column `sql`
+        with. With a keyring, this picks the key named by each value's Key-ID header.
+        Given a connection, keys bound to its session (see PGCRYPTO_SESSION_KEYS) are
+        referred to rather than sent.
+        """
+        if not self.keyring:
+            return key_sql(self.cipher_key, connection)
+        whens = []
+        key_params = list(params)
+        for key_id, key in self.keyring.items():
+            when_sql, when_params = key_sql(key, connection)
+            whens.append("WHEN %%s THEN %s" % when_sql)
+            key_params.extend([key_id, *when_params])
+        default_sql, default_params = key_sql(self.cipher_key, connection)
+        key_params.extend(default_params)
+        return (
+            "CASE substring(%s from '\\n%s: ([^\\n]*)') %s ELSE %s END"
+            % (sql, KEY_ID_HEADER, " ".join(whens), default_sql),
+            key_params,
+        )
+
+    def get_decrypt_sql(self, sql, params=()):
+        """
+        Returns SQL (and its params) for the decrypted and cast value of the column
+        `sql`. This goes through the IMMUTABLE wrapper functions created by the
+        CreateDecryptFunctions migration operation, so lookups on indexable fields
+        and EncryptedIndex produce identical expressions. The key is always inlined
+        here, since an index expression can't depend on session settings.
+        """
+        key_sql, key_params = self.get_key_sql(sql, params)
+        sql = "%s(%s, %s, '%s')" % (
+            self.decrypt_function,
+            sql,
+            key_sql,
+            self.cipher_name,
+        )
+        if self.coalesce:
+            sql = "coalesce(%s, %s)" % (sql, self.coalesce)
+        return sql, (*params, *key_params)
+
 
 class EncryptedTextField(BaseEncryptedField):
     description = _("Text")
@@ -158,6 +782,9 @@ class EncryptedCharField(BaseEncryptedField):
 class EncryptedIntegerField(BaseEncryptedField):
     description = _("Integer")
     field_cast = "::integer"
+    plain_field = models.IntegerField
+    decrypt_function = "pgcrypto_decrypt_integer"
+    binary_codec = codecs.IntegerCodec
 
     def formfield(self, **kwargs):
         defaults = {"form_class": forms.IntegerField}
@@ -166,13 +793,19 @@ class EncryptedIntegerField(BaseEncryptedField):
 
     def to_python(self, value):
         if value:
-            return int(super().to_python(value))
+            return self._parse_value(super().to_python(value))
         return value
 
+    def _parse_value(self, value):
+        return int(value)
+
 
 class EncryptedDecimalField(BaseEncryptedField):
     description = _("Decimal number")
     field_cast = "::numeric"
+    plain_field = models.DecimalField
+    decrypt_function = "pgcrypto_decrypt_numeric"
+    binary_codec = codecs.DecimalCodec
 
     def formfield(self, **kwargs):
         defaults = {"form_class": forms.DecimalField}
@@ -181,13 +814,29 @@ class EncryptedDecimalField(BaseEncryptedField):
 
     def to_python(self, value):
         if value:
-            return decimal.Decimal(super().to_python(value))
+            return self._parse_value(super().to_python(value))
         return value
 
+    def _parse_value(self, value):
+        return decimal.Decimal(value)
+
+    def _blind_index_text(self, value):
+        # 52000 and 52000.00 compare equal in SQL, so they should hash the same.
+        # to_python leaves falsy values (such as 0 or 0.0) as they are, and adding 0
+        # turns -0 into 0.
+        return str((decimal.Decimal(force_str(value)) + 0).normalize())
+
 
 class EncryptedDateField(BaseEncryptedField):
     description = _("Date (without time)")
     field_cast = "::date"
+    plain_field = models.DateField
+    # Casting to a date or timestamp depends on the session's DateStyle and TimeZone,
+    # so these can't be decrypted by an IMMUTABLE function, or indexable.
+    decrypt_function = None
+    binary_codec = codecs.DateCodec
+    # Parses values that aren't ISO 8601 strings, shared rather than built per value.
+    parser = models.DateField()
 
     def __init__(
         self, verbose_name=None, name=None, auto_now=False, auto_now_add=False, **kwargs
@@ -222,7 +871,18 @@ class EncryptedDateField(BaseEncryptedField):
             return super().pre_save(model_instance, add)
 
     def _parse_value(self, value):
-        return models.DateField().to_python(value)
+        if isinstance(value, str):
+            try:
+                return self.parse_iso(value)
+            except ValueError:
+                pass
+        return self.parser.to_python(value)
+
+    def parse_iso(self, value):
+        return datetime.date.fromisoformat(value)
+
+    def _blind_index_text(self, value):
+        return value.isoformat()
 
     def _get_auto_now_value(self):
         return datetime.date.today()
@@ -230,15 +890,25 @@ class EncryptedDateField(BaseEncryptedField):
 
 class EncryptedDateTimeField(EncryptedDateField):
     description = _("Date (with time)")
-    field_cast = "timestamp with time zone"
+    field_cast = "::timestamp with time zone"
+    plain_field = models.DateTimeField
+    binary_codec = codecs.DateTimeCodec
+    parser = models.DateTimeField()
 
     def formfield(self, **kwargs):
         defaults = {"form_class": forms.DateTimeField}
         defaults.update(kwargs)
         return super().formfield(**defaults)
 
-    def _parse_value(self, value):
-        return models.DateTimeField().to_python(value)
+    def parse_iso(self, value):
+        return datetime.datetime.fromisoformat(value)
+
+    def _blind_index_text(self, value):
+        # The same instant hashes the same, whatever offset it was written with.
+        # Naive values are taken to be in the current time zone.
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(datetime.timezone.utc).isoformat()
 
     def _get_auto_now_value(self):
         return timezone.now()
@@ -255,6 +925,111 @@ class EncryptedEmailField(BaseEncryptedField):
         return super().formfield(**defaults)
 
 
+class IndexField:
+    """
+    A companion column computed from the plaintext of its source field (see
+    BlindIndexField and TokenIndexField), and recomputed whenever the row is saved.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.source = kwargs.pop("source")
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("editable", False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["source"] = self.source
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        # The source field adds this automatically, but it is also part of the model
+        # state in migrations, so whichever comes second is ignored.
+        if any(f.name == name for f in cls._meta.local_fields):
+            return
+        super().contribute_to_class(cls, name, *args, **kwargs)
+        post_save.connect(save_index_fields, sender=cls)
+
+    @property
+    def source_field(self):
+        return self.model._meta.get_field(self.source)
+
+    def get_index_value(self, value, source=None):
+        """
+        Returns what is stored for the given value of the source field (or of
+        `source`, a copy of it with other keys).
+        """
+        raise NotImplementedError
+
+    def pre_save(self, model_instance, add):
+        source = self.source_field
+        value = getattr(model_instance, source.attname)
+        plaintext, stored = model_instance.__dict__.get(PREPARED_VALUES, {}).get(
+            source.attname, (None, None)
+        )
+        if stored is not None and value is stored:
+            # Encrypted ahead of a bulk save, so index the plaintext instead.
+            value = plaintext
+        value = self.get_index_value(value)
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def save_index_fields(
+    sender, instance, raw=False, using=None, update_fields=None, **kwargs
+):
+    """
+    A post_save receiver that writes the index columns a save() with update_fields
+    left out, when it included their source fields.
+    """
+    if raw or update_fields is None:
+        return
+    values = {
+        f.attname: f.pre_save(instance, False)
+        for f in sender._meta.concrete_fields
+        if isinstance(f, IndexField)
+        and f.source in update_fields
+        and f.name not in update_fields
+    }
+    if values:
+        sender._base_manager.using(using).filter(pk=instance.pk).update(**values)
+
+
+class BlindIndexField(IndexField, models.CharField):
+    """
+    The companion column added by blind_index=True, holding an HMAC of the plaintext
+    of its source field so exact and IN lookups can use an ordinary B-tree index.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 64)
+        kwargs.setdefault("db_index", True)
+        super().__init__(*args, **kwargs)
+
+    def get_index_value(self, value, source=None):
+        return (source or self.source_field).get_blind_index(value)
+
+
+class TokenIndexField(IndexField, ArrayField):
+    """
+    The companion column added by token_index=True, holding HMACs of the n-grams of
+    its source field, so that pattern lookups can narrow the rows they decrypt with a
+    GIN index on it (which has to be added to the model's Meta.indexes).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs["base_field"] = models.TextField()
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs["base_field"]
+        return name, path, args, kwargs
+
+    def get_index_value(self, value, source=None):
+        return (source or self.source_field).get_tokens(value)
+
+
 class EncryptedLookup(Lookup):
     patterns = {
         "contains": "%%%s%%",
@@ -274,16 +1049,42 @@ class EncryptedLookup(Lookup):
             rhs = connection.operators[self.lookup_name] % rhs
         if self.lookup_name == "exact" and rhs_params == [""]:
             # Special case when looking for blank values, don't try to dearmor/decrypt.
+            if self.lhs.output_field.storage == "bytea":
+                rhs_params = [b""]
             return "%s %s" % (lhs, rhs), lhs_params + rhs_params
-        field_sql = (
-            "convert_from(decrypt(dearmor(nullif(%s, '')), %%s, '%s'), 'utf-8')"
-            % (lhs, self.lhs.output_field.cipher_name)
-        )
-        if self.lhs.output_field.coalesce:
-            field_sql = (
-                "coalesce(" + field_sql + ", " + self.lhs.output_field.coalesce + ")"
+        if self.is_value_equality(rhs_params):
+            if self.lhs.output_field.blind_index and isinstance(self.lhs, Col):
+                return self.as_blind_index(qn, connection, rhs_params)
+            if self.lhs.output_field.deterministic_lookups:
+                return self.as_ciphertext(lhs, lhs_params, rhs_params)
+        field = self.lhs.output_field
+        if not field.codec.sql_compatible:
+            raise NotSupportedError(
+                "%s lookups on %s need the text codec, or a blind index for exact "
+                "and in." % (self.lookup_name, field.name)
+            )
+        if field.indexable:
+            field_sql, field_params = field.get_decrypt_sql(lhs, lhs_params)
+            field_cast = ""
+        else:
+            key_sql, key_params = field.get_key_sql(lhs, lhs_params, connection)
+            field_sql = "convert_from(decrypt(%s, %s, '%s'), 'utf-8')" % (
+                field.get_ciphertext_sql(lhs),
+                key_sql,
+                field.cipher_name,
             )
-        field_internal_type = self.lhs.output_field.get_internal_type()
+            field_params = (*lhs_params, *key_params)
+            if field.coalesce:
+                field_sql = "coalesce(" + field_sql + ", " + field.coalesce + ")"
+            field_cast = field.field_cast
+        if self.lookup_name == "in" and self.is_array(rhs_params):
+            # As text, so values of mixed types can share an array (cast to the
+            # field's type).
+            rhs, rhs_params = self.in_rhs(
+                [None if value is None else str(value) for value in rhs_params],
+                field.field_cast[2:] or "text",
+            )
+        field_internal_type = field.get_internal_type()
         field_sql = (
             connection.ops.lookup_cast(self.lookup_name, field_internal_type)
             % field_sql
@@ -295,24 +1096,108 @@ class EncryptedLookup(Lookup):
             and rhs_params
             and not self.bilateral_transforms
         ):
+            pattern = rhs_params[0]
             rhs_params[0] = self.patterns[
                 self.lookup_name
-            ] % connection.ops.prep_for_like_query(rhs_params[0])
+            ] % connection.ops.prep_for_like_query(pattern)
+            if field.token_index and isinstance(self.lhs, Col):
+                return self.as_token_search(
+                    qn,
+                    field.get_search_tokens(pattern, self.lookup_name),
+                    "%s%s %s" % (field_sql, field_cast, rhs),
+                    (*field_params, *rhs_params),
+                )
+
+        return (
+            "%s%s %s" % (field_sql, field_cast, rhs),
+            (*field_params, *rhs_params),
+        )
+
+    def is_value_equality(self, rhs_params):
+        """
+        Whether this is an exact or IN lookup against plain (non-blank) values, which
+        can be answered without decrypting the column.
+        """
+        return (
+            self.lookup_name in ("exact", "in")
+            and self.rhs_is_direct_value()
+            and not self.bilateral_transforms
+            and all(value not in (None, "") for value in rhs_params)
+        )
+
+    def is_array(self, rhs_params):
+        """
+        Whether this is an IN lookup with more values than PGCRYPTO_IN_ARRAY_THRESHOLD
+        (default 100), which are then passed as a single array parameter.
+        """
+        threshold = getattr(settings, "PGCRYPTO_IN_ARRAY_THRESHOLD", 100)
+        return (
+            self.lookup_name == "in"
+            and self.rhs_is_direct_value()
+            and threshold is not None
+            and len(rhs_params) > threshold
+        )
+
+    def in_rhs(self, params, array_type):
+        """
+        Returns the right-hand side (and its params) of an IN lookup on `params`: a
+        placeholder for each one, or for long lists, "= ANY" an array of `array_type`.
+        """
+        if self.is_array(params):
+            return "= ANY(%%s::%s[])" % array_type, [list(params)]
+        return "IN (%s)" % ", ".join(["%s"] * len(params)), list(params)
 
+    def as_blind_index(self, qn, connection, rhs_params):
+        """
+        Compares the blind index column against the HMACs of the right-hand side,
+        rather than decrypting every row.
+        """
+        field = self.lhs.output_field
+        lhs, lhs_params = qn.compile(Col(self.lhs.alias, field.blind_index_field))
+        params = [field.get_blind_index(value) for value in rhs_params]
+        if self.lookup_name == "in":
+            rhs, params = self.in_rhs(params, "text")
+        else:
+            rhs = "= %s"
+        return "%s %s" % (lhs, rhs), (*lhs_params, *params)
+
+    def as_token_search(self, qn, tokens, sql, params):
+        """
+        Narrows a pattern lookup to the rows whose token index column holds all of
+        the pattern's tokens, which a GIN index can find, so that only those rows are
+        decrypted and compared.
+        """
+        if not tokens:
+            return sql, params
+        field = self.lhs.output_field
+        lhs, lhs_params = qn.compile(Col(self.lhs.alias, field.token_index_field))
         return (
-            "%s%s %s"
-            % (
-                field_sql,
-                self.lhs.output_field.field_cast,
-                rhs,
-            ),
-            (
-                *lhs_params,
-                self.lhs.output_field.cipher_key,
-                *rhs_params,
-            ),
+            "(%s @> %%s::text[] AND %s)" % (lhs, sql),
+            (*lhs_params, tokens, *params),
         )
 
+    def as_ciphertext(self, lhs, lhs_params, rhs_params):
+        """
+        With deterministic_lookups, equal plaintexts encrypt to equal ciphertexts, so
+        the right-hand side is encrypted here and compared to the dearmored column.
+        Comparing the dearmored bytes means armor headers don't matter, and an index
+        on Dearmor(field) (or on the column itself, for bytea storage) can be used.
+        """
+        field = self.lhs.output_field
+        # Each value may be stored under any of the keys.
+        params = [
+            field.get_ciphertext(field.to_python(value), key)
+            for value in rhs_params
+            for key in field.get_keys()
+        ]
+        if self.lookup_name == "in":
+            rhs, params = self.in_rhs(params, "bytea")
+        else:
+            rhs = "= %s"
+        if field.storage == "text":
+            lhs = field.get_ciphertext_sql(lhs)
+        return "%s %s" % (lhs, rhs), (*lhs_params, *params)
+
 
 class EncryptedInLookup(FieldGetDbPrepValueIterableMixin, EncryptedLookup):
     lookup_name = "in"
@@ -1,7 +1,8 @@
 from django.conf import settings
-from django.db.models import Func
+from django.db.models import BinaryField, Func
 
-from .base import aes_pad_key
+from .base import __version__, aes_pad_key
+from .session import key_sql
 
 
 class CryptoFunc(Func):
@@ -10,6 +11,7 @@ class CryptoFunc(Func):
             "cipher_name": kwargs.pop("cipher", None),
             "cipher_key": kwargs.pop("key", None),
             "charset": kwargs.pop("charset", None),
+            "storage": kwargs.pop("storage", None),
         }
 
         super().__init__(*args, **kwargs)
@@ -34,28 +36,78 @@ class CryptoFunc(Func):
 
         return cipher_name, cipher_key, charset
 
+    def get_storage(self):
+        """
+        Returns "bytea" if the encrypted value is stored raw rather than armored.
+        """
+        return self.params["storage"] or getattr(self.field, "storage", "text")
+
 
 class Encrypt(CryptoFunc):
     function = "encrypt"
-    template = (
-        "armor(%(function)s(convert_to(nullif(%(expressions)s, ''), %%s), %%s, %%s))"
+    template = "armor(%(function)s(convert_to(nullif(%(expressions)s, ''), %%s), %(key)s, %%s)%(headers)s)"
+    bytea_template = (
+        "%(function)s(convert_to(nullif(%(expressions)s, ''), %%s), %(key)s, %%s)"
     )
 
-    def as_sql(self, *args, **extra_context):
-        sql, params = super().as_sql(*args, **extra_context)
+    def as_sql(self, compiler, connection, **extra_context):
+        if self.get_storage() == "bytea":
+            extra_context["template"] = self.bytea_template
+        key_id = None
+        if self.params["cipher_key"] is None:
+            # Encrypt with the field's active keyring key, and name it in the armor.
+            key_id = getattr(self.field, "key_id", None)
+        extra_context["headers"] = (
+            "" if key_id is None else ", ARRAY['Version', 'Key-ID'], ARRAY[%s, %s]"
+        )
         cipher_name, cipher_key, charset = self.get_params()
-        params.extend([charset, cipher_key, cipher_name])
+        if key_id is not None:
+            cipher_key = self.field.active_key
+        extra_context["key"], key_params = key_sql(cipher_key, connection)
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        params.extend([charset, *key_params, cipher_name])
+        if key_id is not None:
+            params.extend(["django-pgcrypto %s" % __version__, key_id])
 
         return sql, params
 
 
 class Decrypt(CryptoFunc):
     function = "decrypt"
-    template = "convert_from(%(function)s(dearmor(nullif(%(expressions)s, '')), %%s, %%s), %%s)"
+    template = "convert_from(%(function)s(dearmor(nullif(%(expressions)s, '')), %(key)s, %%s), %%s)"
+    bytea_template = "convert_from(%(function)s(nullif(%(expressions)s, ''::bytea), %(key)s, %%s), %%s)"
+
+    def __init__(self, *args, **kwargs):
+        # With cast=True, the decrypted text is cast using the field's field_cast, so
+        # it compares (and sorts) as a number or date rather than a string.
+        self.cast = kwargs.pop("cast", False)
+        super().__init__(*args, **kwargs)
 
-    def as_sql(self, *args, **extra_context):
-        sql, params = super().as_sql(*args, **extra_context)
+    def as_sql(self, compiler, connection, **extra_context):
         cipher_name, cipher_key, charset = self.get_params()
-        params.extend([cipher_key, cipher_name, charset])
+        extra_context["key"], key_params = key_sql(cipher_key, connection)
+        if self.params["cipher_key"] is None and getattr(self.field, "keyring", None):
+            # Pick the key named by each value's Key-ID header.
+            extra_context["key"], key_params = self.field.get_key_sql(
+                *compiler.compile(self.get_source_expressions()[0]), connection
+            )
+        if self.get_storage() == "bytea":
+            extra_context["template"] = self.bytea_template
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        if self.cast:
+            sql += getattr(self.field, "field_cast", "")
+        params.extend([*key_params, cipher_name, charset])
 
         return sql, params
+
+
+class Dearmor(Func):
+    """
+    The dearmored (raw) ciphertext of an encrypted column. An index on this, e.g.
+    models.Index(Dearmor("ssn"), name="employee_ssn_dearmor"), is what lookups on
+    fields with deterministic_lookups=True compare against.
+    """
+
+    function = "dearmor"
+    template = "%(function)s(nullif(%(expressions)s, ''))"
+    output_field = BinaryField()
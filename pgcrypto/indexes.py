@@ -0,0 +1,36 @@
+from django.db import models
+from django.db.models import F, Func
+
+
+class Decrypted(Func):
+    """
+    The decrypted, typed value of an encrypted field, compiled exactly as lookups on
+    the field compile it when indexable=True (see BaseEncryptedField.get_decrypt_sql).
+    """
+
+    def as_sql(self, compiler, connection, **extra_context):
+        expression = self.get_source_expressions()[0]
+        sql, params = compiler.compile(expression)
+        field = expression.output_field
+        return field.get_decrypt_sql(sql, params)
+
+
+class EncryptedIndex(models.Index):
+    """
+    An expression index on the decrypted values of encrypted fields, usable by range
+    and equality lookups on fields declared with indexable=True. Note that the key is
+    part of the index definition, so it is visible in the database catalog.
+    """
+
+    def __init__(self, *, fields, name, **kwargs):
+        self.encrypted_fields = list(fields)
+        super().__init__(
+            *[Decrypted(F(field_name)) for field_name in self.encrypted_fields],
+            name=name,
+            **kwargs,
+        )
+
+    def deconstruct(self):
+        path, _expressions, kwargs = super().deconstruct()
+        kwargs["fields"] = self.encrypted_fields
+        return path, (), kwargs
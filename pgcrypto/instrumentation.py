@@ -0,0 +1,195 @@
+import re
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .fields import BaseEncryptedField, EncryptedLookup
+
+Measurement = namedtuple("Measurement", ["count", "bytes", "seconds"])
+
+# Appended (as an SQL comment) to each encrypted lookup's SQL while enabled, and
+# replaced by a count of them when the query runs (see tag_query).
+MARKER = "/*pgcrypto:%s*/"
+MARKER_RE = re.compile(r"/\*pgcrypto:([^*]*)\*/")
+
+# Called with (label, operation, count, bytes, seconds) for each measurement.
+hooks = []
+# The original methods replaced by enable(), by class and name.
+originals = {}
+
+
+class Stats:
+    """
+    Sums the measurements it is given as a hook, by field and operation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def __call__(self, label, operation, count, nbytes, seconds):
+        with self.lock:
+            total = self.data.get((label, operation), (0, 0, 0.0))
+            self.data[label, operation] = (
+                total[0] + count,
+                total[1] + nbytes,
+                total[2] + seconds,
+            )
+
+    def snapshot(self):
+        """
+        Returns {(label, operation): Measurement} of everything recorded so far.
+        """
+        with self.lock:
+            return {key: Measurement(*total) for key, total in self.data.items()}
+
+    def reset(self):
+        with self.lock:
+            self.data = {}
+
+
+stats = Stats()
+
+
+def record(label, operation, count, nbytes, seconds):
+    for hook in hooks:
+        hook(label, operation, count, nbytes, seconds)
+
+
+def field_label(field):
+    """
+    Returns "app_label.Model.field" for a field attached to a model, or the label of
+    the field it was copied from by shard_field.
+    """
+    if hasattr(field, "model"):
+        return str(field)
+    return getattr(field, "source_label", None) or field.__class__.__name__
+
+
+def single(args, result):
+    return 1, len(result)
+
+
+def many(args, result):
+    return len(result), sum(len(data) for data in result)
+
+
+def armored(args, result):
+    return 1, len(args[0])
+
+
+# The BaseEncryptedField methods that are timed, the operation they are recorded
+# as, and how to get the (count, bytes) they handled from their args and result.
+OPERATIONS = {
+    "decode_ciphertext": ("dearmor", single),
+    "decrypt": ("decrypt", single),
+    "decrypt_many": ("decrypt", many),
+    "encode_value": ("encode", single),
+    "encrypt": ("encrypt", single),
+    "encrypt_many": ("encrypt", many),
+    "encode_ciphertext": ("armor", armored),
+}
+
+
+def timed(func, operation, measure):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(self, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        count, nbytes = measure(args, result)
+        record(field_label(self), operation, count, nbytes, elapsed)
+        return result
+
+    return wrapper
+
+
+def decode_value(self, data):
+    # BaseEncryptedField.decode_value, timing its two steps separately.
+    start = time.perf_counter()
+    unpadded = self.codec.unpad(data, self.block_size)
+    middle = time.perf_counter()
+    value = self.codec.decode(unpadded)
+    end = time.perf_counter()
+    label = field_label(self)
+    record(label, "unpad", 1, len(data), middle - start)
+    record(label, "parse", 1, len(unpadded), end - middle)
+    return value
+
+
+def as_postgresql(self, qn, connection):
+    sql, params = originals[EncryptedLookup, "as_postgresql"](self, qn, connection)
+    return "%s %s" % (sql, MARKER % field_label(self.lhs.output_field)), params
+
+
+def tag_query(execute, sql, params, many, context):
+    """
+    A database execute wrapper (see connection.execute_wrapper) that replaces the
+    markers of encrypted lookups with a count of them, in a trailing comment such as
+    /*pgcrypto_predicates=2*/, and records how long the query took against each field
+    that was looked up (as the "lookup" operation, counting its predicates).
+    """
+    if "/*pgcrypto:" not in sql:
+        return execute(sql, params, many, context)
+    labels = MARKER_RE.findall(sql)
+    sql = "%s /*pgcrypto_predicates=%d*/" % (MARKER_RE.sub("", sql), len(labels))
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        for label in sorted(set(labels)):
+            record(label, "lookup", labels.count(label), 0, elapsed)
+
+
+def install_wrapper(connection, **kwargs):
+    if tag_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(tag_query)
+
+
+def is_enabled():
+    return bool(originals)
+
+
+def enable(*extra_hooks):
+    """
+    Starts timing the encryption steps of every encrypted field, and the queries
+    with encrypted lookups, reporting each measurement to the default Stats
+    collector (stats), and any extra hooks given. Nothing is timed (or changed)
+    until this is called.
+    """
+    for hook in (stats, *extra_hooks):
+        if hook not in hooks:
+            hooks.append(hook)
+    if is_enabled():
+        return
+    replacements = [
+        (BaseEncryptedField, name, timed(getattr(BaseEncryptedField, name), *spec))
+        for name, spec in OPERATIONS.items()
+    ]
+    replacements.append((BaseEncryptedField, "decode_value", decode_value))
+    replacements.append((EncryptedLookup, "as_postgresql", as_postgresql))
+    for cls, name, replacement in replacements:
+        originals[cls, name] = cls.__dict__[name]
+        setattr(cls, name, replacement)
+    connection_created.connect(install_wrapper)
+    for connection in connections.all(initialized_only=True):
+        install_wrapper(connection)
+
+
+def disable():
+    """
+    Restores the untimed methods, and removes all hooks.
+    """
+    for (cls, name), original in originals.items():
+        setattr(cls, name, original)
+    originals.clear()
+    hooks.clear()
+    connection_created.disconnect(install_wrapper)
+    for connection in connections.all(initialized_only=True):
+        if tag_query in connection.execute_wrappers:
+            connection.execute_wrappers.remove(tag_query)
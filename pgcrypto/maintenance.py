@@ -0,0 +1,236 @@
+from django.db.models import BinaryField, ExpressionWrapper, F, TextField, Value
+from django.db.models.functions import Coalesce
+
+from .base import aes_pad_key
+from .fields import BaseEncryptedField
+from .functions import Decrypt, Encrypt
+from .query import EncryptedQuerySet, index_fields
+
+
+def backfill_blind_indexes(model, fields=None, batch_size=1000, using=None):
+    """
+    Recomputes the blind and token index columns of `model` (or just those of the
+    encrypted `fields` named), walking the table in primary key order, `batch_size`
+    rows at a time. This is a generator, yielding (rows, last_pk) after each batch is
+    written.
+    """
+    indexes = [f for f in index_fields(model) if fields is None or f.source in fields]
+    if not indexes:
+        return
+    pk_name = model._meta.pk.name
+    qs = (
+        EncryptedQuerySet(model, using=using)
+        .only(pk_name, *{f.source for f in indexes})
+        .order_by(pk_name)
+    )
+    manager = model._base_manager.db_manager(using)
+    last_pk = None
+    while True:
+        batch = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        objs = list(batch[:batch_size])
+        if not objs:
+            break
+        for obj in objs:
+            for index in indexes:
+                setattr(
+                    obj,
+                    index.attname,
+                    index.get_index_value(getattr(obj, index.source_field.attname)),
+                )
+        manager.bulk_update(objs, [f.name for f in indexes])
+        last_pk = objs[-1].pk
+        yield len(objs), last_pk
+
+
+def encrypted_fields(model, fields=None):
+    return [
+        f
+        for f in model._meta.concrete_fields
+        if isinstance(f, BaseEncryptedField) and (fields is None or f.name in fields)
+    ]
+
+
+def stored_value(field):
+    """
+    Returns an expression selecting the stored (still encrypted) value of a field.
+    """
+    output_field = BinaryField() if field.storage == "bytea" else TextField()
+    return ExpressionWrapper(F(field.name), output_field)
+
+
+def stored_literal(field, value):
+    """
+    Returns an expression writing a stored (already encrypted) value as it is, so
+    bulk_update doesn't read it through a lazy field's descriptor, which would decrypt
+    it with the configured key.
+    """
+    output_field = BinaryField() if field.storage == "bytea" else TextField()
+    return Value(value, output_field=output_field)
+
+
+def rekeyed_field(field, key):
+    """
+    Returns an unbound copy of the field using the given key (str or bytes), and no
+    keyring.
+    """
+    copy = field.clone()
+    if isinstance(key, str):
+        key = key.encode(field.charset)
+    copy.cipher_key = aes_pad_key(key) if field.cipher_name == "aes" else key
+    copy.keyring, copy.key_id = {}, None
+    return copy
+
+
+def rotate_keys(
+    model,
+    old_key=None,
+    new_key=None,
+    fields=None,
+    batch_size=1000,
+    using=None,
+    streaming=False,
+    start_after=None,
+):
+    """
+    Re-encrypts the encrypted fields of `model` (or just those named in `fields`)
+    from `old_key` to `new_key` (by default, each field's configured key), walking
+    the table in primary key order, `batch_size` rows at a time and starting after
+    the primary key `start_after`, if given. This is a generator, yielding
+    (rows, last_pk) after each batch is committed, so an interrupted rotation can be
+    resumed from the last primary key it yielded. Without an `old_key`, values are
+    decrypted with the keyring key named in their armor, and re-encrypted with the
+    active one.
+
+    By default each batch is a single UPDATE that decrypts and re-encrypts in the
+    database (Encrypt(Decrypt(...))), so no plaintext leaves it, but armor headers
+    other than Key-ID are not kept. With streaming=True, each batch is read,
+    re-encrypted in python and written back with bulk_update, which keeps the
+    field's armor format, skips values already on the active keyring key, and also
+    recomputes blind indexes derived from the key.
+    """
+    fields = encrypted_fields(model, fields)
+    if not fields:
+        return
+    if not streaming and not all(f.codec.sql_compatible for f in fields):
+        raise ValueError("Fields with a binary codec can only be rotated streaming.")
+    if old_key is None:
+        pairs = [(f, f) for f in fields]
+    else:
+        pairs = [
+            (rekeyed_field(f, old_key), rekeyed_field(f, new_key or f.cipher_key))
+            for f in fields
+        ]
+    # Leave out the fields that would be rewritten with the key they already use.
+    rotated = [(f, pair) for f, pair in zip(fields, pairs) if needs_rotation(f, *pair)]
+    if not rotated:
+        return
+    fields, pairs = [f for f, _pair in rotated], [pair for _f, pair in rotated]
+    pk_name = model._meta.pk.name
+    manager = model._base_manager.db_manager(using)
+    qs = manager.order_by(pk_name)
+    last_pk = start_after
+    while True:
+        batch = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        if streaming:
+            rows = list(
+                batch.values_list(
+                    pk_name,
+                    *[stored_value(f) for f in fields],
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            rotate_rows(model, fields, pairs, rows, manager)
+            count, batch_last = len(rows), rows[-1][0]
+        else:
+            pks = list(batch.values_list(pk_name, flat=True)[:batch_size])
+            if not pks:
+                break
+            window = manager.filter(pk__lte=pks[-1])
+            if last_pk is not None:
+                window = window.filter(pk__gt=last_pk)
+            window.update(
+                **{
+                    field.name: Coalesce(
+                        rotate_expression(field, old, new),
+                        F(field.name),
+                    )
+                    for field, (old, new) in zip(fields, pairs)
+                }
+            )
+            count, batch_last = len(pks), pks[-1]
+        last_pk = batch_last
+        yield count, last_pk
+
+
+def needs_rotation(field, old, new):
+    """
+    Whether rotating a field from `old` to `new` (rekeyed copies of it, or the field
+    itself to rotate onto its keyring's active key) can change any of its values.
+    """
+    if old is field:
+        return bool(field.keyring)
+    return old.cipher_key != new.cipher_key
+
+
+def rotate_expression(field, old, new):
+    """
+    Returns Encrypt(Decrypt(field)), using the keys of the `old` and `new` rekeyed
+    fields, or the field's keyring if they are the field itself.
+    """
+    if old is field:
+        return Encrypt(Decrypt(F(field.name)))
+    return Encrypt(Decrypt(F(field.name), key=old.cipher_key), key=new.cipher_key)
+
+
+def rotate_rows(model, fields, pairs, rows, manager):
+    """
+    Re-encrypts one batch of (pk, *armored values) rows in python, and saves the ones
+    that changed.
+    """
+    objs = [model(pk=row[0]) for row in rows]
+    changed = set()
+    update_fields = []
+    for pos, (field, (old, new)) in enumerate(zip(fields, pairs), 1):
+        for obj, row in zip(objs, rows):
+            setattr(obj, field.attname, stored_literal(field, row[pos]))
+        # Positions and ciphertexts of the values to re-encrypt, by their old key.
+        groups = {}
+        for idx, row in enumerate(rows):
+            if not old.is_encrypted(row[pos]):
+                continue
+            if old is new and new.is_active_key(row[pos]):
+                continue
+            positions, ciphertexts = groups.setdefault(
+                old.get_value_key(row[pos]), ([], [])
+            )
+            positions.append(idx)
+            ciphertexts.append(old.decode_ciphertext(row[pos]))
+        # Blind and token indexes are keyed by the encryption key, unless they have
+        # their own.
+        rekeyed = [
+            index
+            for index in index_fields(model)
+            if index.source == field.name
+            and field.blind_index_key is None
+            and old.cipher_key != new.cipher_key
+        ]
+        for key, (positions, ciphertexts) in groups.items():
+            # Decrypted values are still padded, so they can be encrypted as they are.
+            for idx, data in zip(positions, old.decrypt_many(ciphertexts, key)):
+                changed.add(idx)
+                setattr(
+                    objs[idx],
+                    field.attname,
+                    stored_literal(field, new.encode_ciphertext(new.encrypt(data))),
+                )
+                for index in rekeyed:
+                    setattr(
+                        objs[idx],
+                        index.attname,
+                        index.get_index_value(field.decode_value(data), new),
+                    )
+        update_fields.append(field.name)
+        update_fields.extend(index.name for index in rekeyed)
+    if changed:
+        manager.bulk_update([objs[idx] for idx in sorted(changed)], update_fields)
@@ -0,0 +1,36 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from pgcrypto.maintenance import backfill_blind_indexes
+
+
+class Command(BaseCommand):
+    help = "Recomputes the blind and token indexes of a model's encrypted fields."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to backfill, as app_label.Model.")
+        parser.add_argument(
+            "--field",
+            action="append",
+            dest="fields",
+            help="Only backfill this encrypted field (may be given more than once).",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        total = 0
+        for rows, last_pk in backfill_blind_indexes(
+            model,
+            fields=options["fields"],
+            batch_size=options["batch_size"],
+            using=options["database"],
+        ):
+            total += rows
+            if options["verbosity"] > 1:
+                self.stdout.write("%d rows (last pk %s)" % (total, last_pk))
+        self.stdout.write("Backfilled %d rows of %s." % (total, model._meta.label))
@@ -0,0 +1,79 @@
+from django.apps import apps
+from django.core.exceptions import FieldError
+from django.core.management.base import BaseCommand, CommandError
+
+from pgcrypto.diagnostics import (
+    ExpensiveDecryptionError,
+    explain,
+    get_threshold,
+    report,
+)
+
+
+class Command(BaseCommand):
+    help = "Reports how many rows a filter on a model decrypts in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to query, as app_label.Model.")
+        parser.add_argument(
+            "filters",
+            nargs="*",
+            metavar="lookup=value",
+            help="Filters, such as ssn__icontains=123 (separate in values by commas).",
+        )
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run the query with EXPLAIN ANALYZE, to count the rows decrypted.",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=int,
+            help="Fail if a filter decrypts more rows than this (default: "
+            "PGCRYPTO_EXPLAIN_THRESHOLD).",
+        )
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        filters = {}
+        for item in options["filters"]:
+            lookup, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError("Filters must be given as lookup=value: %s" % item)
+            filters[lookup] = value.split(",") if lookup.endswith("__in") else value
+        try:
+            queryset = model._base_manager.db_manager(options["database"]).filter(
+                **filters
+            )
+            predicates = explain(queryset, analyze=options["analyze"])
+        except FieldError as e:
+            raise CommandError(str(e))
+        if not predicates:
+            self.stdout.write("Nothing is decrypted in the database.")
+        for predicate in predicates:
+            if predicate.indexed:
+                self.stdout.write(
+                    "%s: read from an index (%s)" % (predicate.field, predicate.node)
+                )
+            else:
+                self.stdout.write(
+                    "%s: %s%d rows decrypted (%s)"
+                    % (
+                        predicate.field,
+                        "" if options["analyze"] else "~",
+                        predicate.rows,
+                        predicate.node,
+                    )
+                )
+            if options["verbosity"] > 1:
+                self.stdout.write("    %s" % predicate.condition)
+        threshold = get_threshold(options["threshold"])
+        if threshold is not None:
+            try:
+                report(predicates, threshold, "raise")
+            except ExpensiveDecryptionError as e:
+                raise CommandError(str(e))
@@ -0,0 +1,143 @@
+import getpass
+import json
+import os
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from pgcrypto.maintenance import encrypted_fields, rotate_keys
+
+# Environment variables holding the keys, so they don't show up in process lists or
+# shell history as arguments would.
+OLD_KEY_VARIABLE = "PGCRYPTO_ROTATE_OLD_KEY"
+NEW_KEY_VARIABLE = "PGCRYPTO_ROTATE_NEW_KEY"
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypts a model's encrypted fields with a new key. The current key is "
+        "read from %s (or --old-key-file, or --prompt); without one, fields are "
+        "rotated onto the active key of their keyring (PGCRYPTO_KEYRING). The key to "
+        "re-encrypt with is read from %s (or --new-key-file, or --prompt), and "
+        "defaults to each field's configured key."
+        % (OLD_KEY_VARIABLE, NEW_KEY_VARIABLE)
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to rotate, as app_label.Model.")
+        parser.add_argument("--old-key-file", help="A file holding the current key.")
+        parser.add_argument(
+            "--new-key-file", help="A file holding the key to re-encrypt with."
+        )
+        parser.add_argument(
+            "--prompt",
+            action="store_true",
+            help="Prompt for the keys not given in a file or the environment.",
+        )
+        parser.add_argument(
+            "--field",
+            action="append",
+            dest="fields",
+            help="Only rotate this encrypted field (may be given more than once).",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--database", default="default")
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            help="Re-encrypt in python rather than with an UPDATE in the database.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="A file recording the last primary key rotated, to resume from.",
+        )
+        parser.add_argument(
+            "--throttle",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches, to limit the load on the database.",
+        )
+
+    def get_key(self, options, path, variable, prompt):
+        """
+        Returns a key from the file at `path`, the environment `variable`, or (with
+        --prompt) typed in without echoing it, or None.
+        """
+        if path:
+            try:
+                with open(path) as f:
+                    return f.read().rstrip("\r\n")
+            except OSError as e:
+                raise CommandError(str(e))
+        if os.environ.get(variable):
+            return os.environ[variable]
+        if options["prompt"]:
+            return getpass.getpass(prompt) or None
+        return None
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        old_key = self.get_key(
+            options,
+            options["old_key_file"],
+            OLD_KEY_VARIABLE,
+            "Current key (blank to use the keyring): ",
+        )
+        new_key = self.get_key(
+            options,
+            options["new_key_file"],
+            NEW_KEY_VARIABLE,
+            "New key (blank for the configured key): ",
+        )
+        if old_key is None and not any(
+            f.keyring for f in encrypted_fields(model, options["fields"])
+        ):
+            raise CommandError(
+                "The current key (%s, --old-key-file or --prompt) is required for "
+                "fields without a keyring." % OLD_KEY_VARIABLE
+            )
+        checkpoint = options["checkpoint"]
+        start_after = None
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start_after = json.load(f)["last_pk"]
+            self.stdout.write("Resuming after pk %s." % start_after)
+        total = 0
+        started = time.monotonic()
+        for rows, last_pk in rotate_keys(
+            model,
+            old_key,
+            new_key=new_key,
+            fields=options["fields"],
+            batch_size=options["batch_size"],
+            using=options["database"],
+            streaming=options["streaming"],
+            start_after=start_after,
+        ):
+            total += rows
+            if checkpoint:
+                with open(checkpoint, "w") as f:
+                    json.dump({"last_pk": last_pk}, f, default=str)
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    "%d rows (last pk %s, %.0f rows/sec)"
+                    % (total, last_pk, total / max(time.monotonic() - started, 1e-6))
+                )
+            if options["throttle"]:
+                time.sleep(options["throttle"])
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            "Rotated %d rows of %s in %.1fs (%.0f rows/sec)."
+            % (total, model._meta.label, elapsed, total / max(elapsed, 1e-6))
+        )
+        if not options["streaming"] and any(
+            f.blind_index and f.blind_index_key is None
+            for f in encrypted_fields(model, options["fields"])
+        ):
+            self.stdout.write(
+                "Blind indexes are derived from the key, run pgcrypto_backfill next."
+            )
@@ -0,0 +1,108 @@
+from django.db.migrations.operations import AlterField, RunSQL
+
+from .fields import BaseEncryptedField, EncryptedDecimalField, EncryptedIntegerField
+
+DECRYPT_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION %(name)s(data %(storage)s, key bytea, cipher text)
+RETURNS %(type)s AS $$
+    SELECT convert_from(decrypt(%(ciphertext)s, key, cipher), 'utf-8')%(cast)s
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+"""
+
+# The ciphertext of the data argument, for each storage (see get_ciphertext_sql).
+CIPHERTEXT_SQL = {
+    "text": "dearmor(nullif(data, ''))",
+    "bytea": "nullif(data, ''::bytea)",
+}
+
+
+def decrypt_functions():
+    """
+    Returns (name, return type, cast) for each of the wrapper functions used by
+    BaseEncryptedField.get_decrypt_sql.
+    """
+    return [
+        (cls.decrypt_function, cls.field_cast[2:] or "text", cls.field_cast)
+        for cls in (BaseEncryptedField, EncryptedIntegerField, EncryptedDecimalField)
+    ]
+
+
+class CreateDecryptFunctions(RunSQL):
+    """
+    Creates the pgcrypto_decrypt* SQL functions that indexable fields and
+    EncryptedIndex use. They are declared IMMUTABLE (which decrypt with a fixed key,
+    and casting to text, integer or numeric, are), so PostgreSQL allows them in index
+    expressions. The pgcrypto extension
+    must already exist, e.g. from django.contrib.postgres's CryptoExtension.
+    """
+
+    def __init__(self):
+        super().__init__(
+            [
+                DECRYPT_FUNCTION_SQL
+                % {
+                    "name": name,
+                    "storage": storage,
+                    "type": type_,
+                    "ciphertext": ciphertext,
+                    "cast": cast,
+                }
+                for name, type_, cast in decrypt_functions()
+                for storage, ciphertext in CIPHERTEXT_SQL.items()
+            ],
+            [
+                "DROP FUNCTION IF EXISTS %s(%s, bytea, text);" % (name, storage)
+                for name, _type, _cast in decrypt_functions()
+                for storage in CIPHERTEXT_SQL
+            ],
+        )
+
+    def deconstruct(self):
+        return self.__class__.__name__, [], {}
+
+    def describe(self):
+        return "Creates the pgcrypto_decrypt SQL functions"
+
+
+class AlterEncryptedStorage(AlterField):
+    """
+    Use in place of the AlterField that makemigrations writes when an encrypted
+    field's storage changes. Existing values are converted in place, by dearmoring
+    them into the new bytea column (or armoring them back into a text column).
+    Armor headers, such as Key-ID, are not kept. Only the storage is changed, so
+    make any other changes to the field in a separate operation.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self.convert(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self.convert(app_label, schema_editor, from_state, to_state)
+
+    def convert(self, app_label, schema_editor, from_state, to_state):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        from_field = from_model._meta.get_field(self.name)
+        to_field = to_model._meta.get_field(self.name)
+        if getattr(from_field, "storage", None) == getattr(to_field, "storage", None):
+            schema_editor.alter_field(from_model, from_field, to_field)
+            return
+        column = schema_editor.quote_name(from_field.column)
+        if to_field.storage == "bytea":
+            using = "CASE WHEN %s = '' THEN ''::bytea ELSE dearmor(%s) END"
+        else:
+            using = "CASE WHEN %s = ''::bytea THEN '' ELSE armor(%s) END"
+        schema_editor.execute(
+            "ALTER TABLE %s ALTER COLUMN %s TYPE %s USING %s"
+            % (
+                schema_editor.quote_name(to_model._meta.db_table),
+                column,
+                to_field.db_type(schema_editor.connection),
+                using % (column, column),
+            )
+        )
+
+    def describe(self):
+        return "Convert the storage of %s on %s" % (self.name, self.model_name)
@@ -0,0 +1,594 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from itertools import chain, islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import NotSupportedError, connections, models
+from django.db.models import F, Func
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Col
+from django.db.models.sql import Query
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE, MULTI
+
+from .fields import PREPARED_VALUES, BaseEncryptedField, IndexField
+from .functions import Decrypt
+from .indexes import Decrypted
+
+logger = logging.getLogger("pgcrypto")
+
+
+class BatchDecryptCompilerMixin:
+    """
+    Mixed into the backend's SQLCompiler by EncryptedQuery. Rather than decrypting
+    each encrypted cell through from_db_value as rows are converted, every encrypted
+    column of a fetched chunk is handed to its field's from_db_values at once.
+    """
+
+    batch_decrypt = False
+    encrypted_columns = None
+
+    def get_select(self, *args, **kwargs):
+        select, klass_info, annotations = super().get_select(*args, **kwargs)
+        fields = self.query.decrypted_in_db
+        if fields is not None:
+            for pos, (expression, _sql, alias) in enumerate(select):
+                field = getattr(expression, "target", None)
+                if (
+                    isinstance(expression, Col)
+                    and isinstance(field, BaseEncryptedField)
+                    and field.codec.sql_compatible
+                    and (fields is True or field in fields)
+                ):
+                    decrypted = DecryptedColumn(expression)
+                    select[pos] = (decrypted, self.compile(decrypted), alias)
+        return select, klass_info, annotations
+
+    def get_converters(self, expressions):
+        # Only the top-level call made by results_iter is batched (get_converters
+        # recurses for composite fields, and is used directly for aggregates).
+        batch, self.batch_decrypt = self.batch_decrypt, False
+        converters = super().get_converters(expressions)
+        if batch:
+            self.encrypted_columns = {}
+            model_columns = self.model_columns()
+            for pos, (convs, _expression) in list(converters.items()):
+                field = getattr(convs[0], "__self__", None)
+                if (
+                    len(convs) == 1
+                    and isinstance(field, BaseEncryptedField)
+                    and convs[0].__name__ == "from_db_value"
+                ):
+                    # Lazy fields of model instances are decrypted when they're read.
+                    if not (field.lazy and pos in model_columns):
+                        self.encrypted_columns[pos] = field
+                    del converters[pos]
+        return converters
+
+    def model_columns(self):
+        """
+        Returns the positions of the selected columns that are loaded into model
+        instances (including those of select_related models).
+        """
+        positions = set()
+        if self.query.values_select:
+            # values() and values_list() still have a klass_info.
+            return positions
+        pending = [self.klass_info] if self.klass_info else []
+        while pending:
+            info = pending.pop()
+            positions.update(info["select_fields"])
+            pending.extend(info.get("related_klass_infos", ()))
+        return positions
+
+    def prepare_encrypted_columns(self):
+        """
+        Finds the encrypted columns of an executed query (as results_iter would),
+        returning {position: field}.
+        """
+        self.batch_decrypt = True
+        self.get_converters([s[0] for s in self.select[0 : self.col_count]])
+        return self.encrypted_columns
+
+    def execute_sql(
+        self, result_type=MULTI, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE
+    ):
+        chunks = self.query.decrypted_chunks
+        if chunks is None or result_type != MULTI:
+            return super().execute_sql(result_type, chunked_fetch, chunk_size)
+        # EncryptedQuerySet.aiterator has already fetched and decrypted the rows, so
+        # this only sets up the compiler (select, klass_info) to convert them.
+        try:
+            self.as_sql()
+        except EmptyResultSet:
+            pass
+        return chunks
+
+    def results_iter(
+        self,
+        results=None,
+        tuple_expected=False,
+        chunked_fetch=False,
+        chunk_size=GET_ITERATOR_CHUNK_SIZE,
+    ):
+        if results is None:
+            results = self.execute_sql(
+                MULTI, chunked_fetch=chunked_fetch, chunk_size=chunk_size
+            )
+        if self.query.decrypted_chunks is None:
+            results = self.decrypt_chunks(results)
+        self.batch_decrypt = True
+        try:
+            return super().results_iter(
+                results,
+                tuple_expected=tuple_expected,
+                chunked_fetch=chunked_fetch,
+                chunk_size=chunk_size,
+            )
+        finally:
+            self.batch_decrypt = False
+
+    def decrypt_chunks(self, results):
+        workers, processes, executor = self.query.get_parallel()
+        if not self.encrypted_columns:
+            workers = None
+        context = executor_context(workers, processes, executor)
+        if workers and isinstance(results, list):
+            # Everything has already been fetched, so decrypt it as one chunk rather
+            # than paying the pool overhead for every fetchmany() batch.
+            results = [list(chain.from_iterable(results))]
+        with context as executor:
+            shard_fields = {}
+            for rows in results:
+                if self.encrypted_columns and rows:
+                    rows = [list(row) for row in rows]
+                    for pos, field in self.encrypted_columns.items():
+                        values = [row[pos] for row in rows]
+                        if workers and len(values) >= workers * PARALLEL_MIN_SHARD:
+                            if pos not in shard_fields:
+                                shard_fields[pos] = (
+                                    shard_field(field) if processes else field
+                                )
+                            values = decrypt_parallel(
+                                shard_fields[pos], values, executor, workers
+                            )
+                        else:
+                            values = field.from_db_values(values)
+                        for row, value in zip(rows, values):
+                            row[pos] = value
+                yield rows
+
+
+# Columns with fewer than this many values per worker are decrypted inline, since
+# handing them to a pool would cost more than it saves.
+PARALLEL_MIN_SHARD = 256
+
+
+def decrypt_shard(field, values):
+    return field.from_db_values(values)
+
+
+def encrypt_shard(field, values):
+    return field.get_db_prep_save_many(values)
+
+
+def executor_context(workers, processes, executor):
+    """
+    Returns a context manager for the executor to use for parallel() settings: the
+    given executor, a new pool of `workers` processes or threads (shut down on exit),
+    or None if there are no workers.
+    """
+    if executor is not None:
+        return nullcontext(executor)
+    if not workers:
+        return nullcontext()
+    if processes:
+        return ProcessPoolExecutor(workers)
+    return ThreadPoolExecutor(workers)
+
+
+def shard_field(field):
+    """
+    Returns an unbound copy of the field, which (unlike a field attached to a model)
+    pickles with its key and options so it can be sent to a worker process.
+    """
+    copy = field.clone()
+    copy.cipher_key = field.cipher_key
+    copy.keyring, copy.key_id = field.keyring, field.key_id
+    copy.decrypt_cache, copy.encrypt_cache = field.decrypt_cache, field.encrypt_cache
+    if hasattr(field, "model"):
+        # Used by instrumentation, to report measurements against the original.
+        copy.source_label = str(field)
+    return copy
+
+
+def execute_chunked(queryset, chunk_size):
+    """
+    Runs a queryset's query, returning an iterator over chunks of its rows as they
+    come from the database, and its encrypted columns ({position: field}).
+    """
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    chunked_fetch = not connections[queryset.db].settings_dict.get(
+        "DISABLE_SERVER_SIDE_CURSORS"
+    )
+    results = compiler.execute_sql(
+        MULTI, chunked_fetch=chunked_fetch, chunk_size=chunk_size
+    )
+    return iter(results), compiler.prepare_encrypted_columns()
+
+
+async def decrypt_chunk_async(rows, columns, executor=None):
+    """
+    Decrypts the encrypted `columns` ({position: field}) of a chunk of rows on an
+    executor (or the event loop's default one), a column per job, and returns the
+    rows as lists.
+    """
+    loop = asyncio.get_running_loop()
+    rows = [list(row) for row in rows]
+    columns = list(columns.items())
+    decrypted = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                executor, decrypt_shard, field, [row[pos] for row in rows]
+            )
+            for pos, field in columns
+        ]
+    )
+    for (pos, _field), values in zip(columns, decrypted):
+        for row, value in zip(rows, values):
+            row[pos] = value
+    return rows
+
+
+def decrypt_parallel(field, values, executor, shards, function=decrypt_shard):
+    """
+    Splits values into one contiguous shard per worker, decrypts them (or applies
+    another shard `function`) on the executor and returns the results in their
+    original order.
+    """
+    size = -(-len(values) // shards)
+    parts = [values[start : start + size] for start in range(0, len(values), size)]
+    results = []
+    for part in executor.map(function, [field] * len(parts), parts):
+        results.extend(part)
+    return results
+
+
+@contextmanager
+def prepared_for_save(queryset, objs, fields, operation):
+    """
+    Encrypts the values of the encrypted `fields` of `objs` together (see
+    get_db_prep_save_many, and parallel()), and puts the stored values in place of
+    the plaintexts while the bulk `operation` runs, restoring them afterwards. How
+    long the encryption and the rest of the operation took is logged (at DEBUG, to
+    the "pgcrypto" logger), to help with sizing batches.
+    """
+    started = time.perf_counter()
+    # An object passed more than once is only prepared (and restored) once.
+    objs = list({id(obj): obj for obj in objs}.values())
+    workers, processes, executor = queryset.query.get_parallel()
+    prepared = []
+    with executor_context(workers, processes, executor) as executor:
+        for field in fields:
+            values = [getattr(obj, field.attname) for obj in objs]
+            if workers and len(values) >= workers * PARALLEL_MIN_SHARD:
+                stored = decrypt_parallel(
+                    shard_field(field) if processes else field,
+                    values,
+                    executor,
+                    workers,
+                    function=encrypt_shard,
+                )
+            else:
+                stored = field.get_db_prep_save_many(values)
+            for obj, value, new in zip(objs, values, stored):
+                if new is not value:
+                    obj.__dict__.setdefault(PREPARED_VALUES, {})[field.attname] = (
+                        value,
+                        new,
+                    )
+                    setattr(obj, field.attname, new)
+                    prepared.append((obj, field.attname))
+    encrypted = time.perf_counter()
+    try:
+        yield
+    finally:
+        for obj, attname in prepared:
+            value, new = obj.__dict__[PREPARED_VALUES].pop(attname)
+            # Leave anything the operation set itself (e.g. pre_save) alone.
+            if getattr(obj, attname) is new:
+                setattr(obj, attname, value)
+        for obj in objs:
+            if not obj.__dict__.get(PREPARED_VALUES, True):
+                del obj.__dict__[PREPARED_VALUES]
+        logger.debug(
+            "%s of %d %s objects: encrypted %d values in %.3fs, saved in %.3fs",
+            operation,
+            len(objs),
+            queryset.model._meta.label,
+            len(prepared),
+            encrypted - started,
+            time.perf_counter() - encrypted,
+        )
+
+
+@lru_cache(maxsize=None)
+def batch_decrypt_compiler(compiler_class):
+    return type(
+        "BatchDecrypt%s" % compiler_class.__name__,
+        (BatchDecryptCompilerMixin, compiler_class),
+        {},
+    )
+
+
+class EncryptedQuery(Query):
+    """
+    A Query whose SELECT compilers decrypt encrypted columns a chunk at a time.
+    """
+
+    parallel = None
+    # The fields EncryptedQuerySet.decrypt_in_db selects decrypted (or True for all).
+    decrypted_in_db = None
+    # Set by EncryptedQuerySet.aiterator on the query it converts rows for.
+    decrypted_chunks = None
+
+    def get_parallel(self):
+        """
+        Returns (workers, processes, executor) for decrypting this query's results,
+        from EncryptedQuerySet.parallel() or the PGCRYPTO_PARALLEL_WORKERS setting.
+        """
+        if self.parallel is not None:
+            return self.parallel
+        return getattr(settings, "PGCRYPTO_PARALLEL_WORKERS", None), False, None
+
+    def get_compiler(self, using=None, connection=None, elide_empty=True):
+        compiler = super().get_compiler(using, connection, elide_empty)
+        compiler.__class__ = batch_decrypt_compiler(compiler.__class__)
+        return compiler
+
+
+class EncryptedQuerySet(models.QuerySet):
+    """
+    A QuerySet that decrypts the encrypted columns of each fetched chunk (see
+    QuerySet.iterator's chunk_size) in one pass, instead of cell by cell.
+    """
+
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        super().__init__(model, query or EncryptedQuery(model), using, hints)
+
+    def parallel(self, workers=None, processes=False, executor=None):
+        """
+        Decrypt large chunks of results across a pool of `workers` (default: the CPU
+        count), split into contiguous shards and reassembled in row order. A pool is
+        created for each evaluation, using processes if processes=True and threads
+        otherwise; pass an existing concurrent.futures executor to reuse one instead.
+        Use parallel(0) to turn it off.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        clone = self._chain()
+        clone.query.parallel = (workers, processes, executor)
+        return clone
+
+    async def aiterator(self, chunk_size=2000):
+        """
+        Like QuerySet.aiterator, but each fetched chunk is decrypted on an executor
+        rather than in the thread Django runs database work in, so other requests'
+        queries aren't held up behind it, and the next chunk is fetched while the
+        current one is decrypted. Rows are yielded chunk by chunk as they're ready.
+        The executor is the one given to parallel() (or a pool of its size, or of
+        PGCRYPTO_PARALLEL_WORKERS), or else the event loop's default executor.
+        """
+        if self._prefetch_related_lookups:
+            async for item in super().aiterator(chunk_size):
+                yield item
+            return
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be strictly positive.")
+        qs = self._chain()
+        results, columns = await sync_to_async(execute_chunked)(qs, chunk_size)
+        # Rows are converted to objects by the usual iterable, reading decrypted
+        # chunks from this queue instead of the database.
+        ready = deque()
+        source = qs._chain()
+        source.query.decrypted_chunks = iter(ready.popleft, None)
+        converted = iter(source._iterable_class(source, chunk_size=chunk_size))
+        workers, processes, executor = qs.query.get_parallel()
+        context = executor_context(workers, processes, executor)
+        if processes:
+            columns = {pos: shard_field(field) for pos, field in columns.items()}
+        fetch = sync_to_async(next)
+        pending = None
+        try:
+            with context as executor:
+                pending = asyncio.ensure_future(fetch(results, None))
+                while True:
+                    rows = await pending
+                    pending = None
+                    if not rows:
+                        break
+                    pending = asyncio.ensure_future(fetch(results, None))
+                    if columns:
+                        rows = await decrypt_chunk_async(rows, columns, executor)
+                    ready.append(rows)
+                    # Each row converts to exactly one item.
+                    items = await sync_to_async(list)(islice(converted, len(rows)))
+                    for item in items:
+                        yield item
+        finally:
+            if pending is not None:
+                await pending
+            if hasattr(results, "close"):
+                await sync_to_async(results.close)()
+
+    def decrypt_in_db(self, *field_names):
+        """
+        Decrypt the named encrypted fields (by default, all of them except those with
+        a binary codec) in the database, selecting their plaintext as typed columns,
+        so no dearmoring or decryption happens in python. This moves the work to the
+        database server, and sends plaintext over the connection. Use
+        decrypt_in_db(None) to turn it off.
+        """
+        clone = self._chain()
+        if field_names == (None,):
+            clone.query.decrypted_in_db = None
+        elif not field_names:
+            clone.query.decrypted_in_db = True
+        else:
+            fields = [self.model._meta.get_field(name) for name in field_names]
+            for field in fields:
+                if not isinstance(field, BaseEncryptedField):
+                    raise ValueError("%s is not an encrypted field." % field.name)
+                if not field.codec.sql_compatible:
+                    raise NotSupportedError(
+                        "Cannot decrypt %s in the database, which uses a binary codec."
+                        % field.name
+                    )
+            clone.query.decrypted_in_db = frozenset(fields)
+        return clone
+
+    def order_by(self, *field_names):
+        """
+        Orders by the decrypted (and cast) values of any encrypted fields, so sorting
+        and slicing happen in the database instead of by armored text.
+        """
+        return super().order_by(
+            *[decrypted_ordering(self.model, name) for name in field_names]
+        )
+
+    def update(self, **kwargs):
+        # Keep blind and token indexes in step with plain values (expressions can't
+        # be hashed here, so those rows need a backfill afterwards).
+        for index in index_fields(self.model):
+            value = kwargs.get(index.source)
+            if index.source in kwargs and not hasattr(value, "resolve_expression"):
+                kwargs.setdefault(index.name, index.get_index_value(value))
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Encrypts the values of all the objects' encrypted fields in one pass (across
+        a pool, with parallel()) before inserting them.
+        """
+        objs = list(objs)
+        fields = [
+            f
+            for f in bulk_encrypted_fields(self.model)
+            # These set their own value in pre_save.
+            if not getattr(f, "auto_now", False)
+            and not getattr(f, "auto_now_add", False)
+        ]
+        with prepared_for_save(self, objs, fields, "bulk_create"):
+            return super().bulk_create(objs, *args, **kwargs)
+
+    bulk_create.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Keeps blind and token indexes in step, and encrypts the values of the updated
+        encrypted fields in one pass (as bulk_create does) before updating them.
+        """
+        objs = tuple(objs)
+        fields = list(fields)
+        for index in index_fields(self.model):
+            if index.source in fields and index.name not in fields:
+                attname = index.source_field.attname
+                for obj in objs:
+                    setattr(
+                        obj, index.attname, index.get_index_value(getattr(obj, attname))
+                    )
+                fields.append(index.name)
+        encrypted = [f for f in bulk_encrypted_fields(self.model) if f.name in fields]
+        with prepared_for_save(self, objs, encrypted, "bulk_update"):
+            return super().bulk_update(objs, fields, batch_size=batch_size)
+
+    bulk_update.alters_data = True
+
+
+def decrypted_ordering(model, name):
+    """
+    Returns the ordering expression for an order_by() argument naming an encrypted
+    field (possibly across relations, and with a "-" prefix), or the argument itself
+    for anything else. Indexable fields order by the same expression EncryptedIndex
+    uses, so an index can satisfy ORDER BY ... LIMIT.
+    """
+    if not isinstance(name, str) or name == "?":
+        return name
+    path = name.lstrip("-")
+    field = None
+    for part in path.split(LOOKUP_SEP):
+        if model is None:
+            return name
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return name
+        model = field.related_model
+    if not isinstance(field, BaseEncryptedField):
+        return name
+    if not field.codec.sql_compatible:
+        raise NotSupportedError("Cannot order by %s, which uses a binary codec." % path)
+    if field.indexable:
+        expression = Decrypted(F(path))
+    else:
+        expression = Decrypt(F(path), cast=True)
+    return expression.desc() if name.startswith("-") else expression.asc()
+
+
+class DecryptedColumn(Func):
+    """
+    The decrypted value of an encrypted column (see decrypt_in_db), cast and typed as
+    the field's plain counterpart. Blank values stay blank, as from_db_value leaves
+    them.
+    """
+
+    def __init__(self, column):
+        super().__init__(column, output_field=column.target.plain_field())
+
+    @property
+    def target(self):
+        # Model instances are populated by the target field of each selected column.
+        return self.get_source_expressions()[0].target
+
+    def as_sql(self, compiler, connection, **extra_context):
+        column = self.get_source_expressions()[0]
+        field = column.target
+        sql, params = compiler.compile(Decrypt(column, cast=True))
+        if field.plain_field is models.TextField:
+            column_sql, column_params = compiler.compile(column)
+            blank = "''::bytea" if field.storage == "bytea" else "''"
+            sql = "CASE WHEN %s = %s THEN '' ELSE %s END" % (column_sql, blank, sql)
+            params = (*column_params, *params)
+        return sql, params
+
+
+def bulk_encrypted_fields(model):
+    """
+    The encrypted fields of a model whose values the bulk methods encrypt ahead of
+    saving. Lazy fields are left to pre_save, which keeps unread values as they are.
+    """
+    return [
+        f
+        for f in model._meta.concrete_fields
+        if isinstance(f, BaseEncryptedField) and not f.lazy
+    ]
+
+
+def index_fields(model):
+    """
+    The blind and token index columns of a model's encrypted fields.
+    """
+    return [f for f in model._meta.concrete_fields if isinstance(f, IndexField)]
+
+
+class EncryptedManager(models.Manager.from_queryset(EncryptedQuerySet)):
+    pass
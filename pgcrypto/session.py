@@ -0,0 +1,60 @@
+import hashlib
+
+from django.apps import apps
+
+# The attribute of a database connection holding {key: setting name} for the keys
+# bound to its session by bind_session_keys.
+SESSION_KEYS = "pgcrypto_session_keys"
+
+
+def setting_name(key):
+    """
+    Returns the name of the session setting a key is bound to, which identifies it
+    without revealing it.
+    """
+    digest = hashlib.sha256(b"django-pgcrypto session key:" + key).hexdigest()
+    return "pgcrypto.key_%s" % digest[:16]
+
+
+def key_sql(key, connection=None):
+    """
+    Returns SQL (and its params) for a key: a reference to the session setting it's
+    bound to on the connection, or else the key itself as a parameter.
+    """
+    name = getattr(connection, SESSION_KEYS, {}).get(key)
+    if name is None:
+        return "%s", [key]
+    return "decode(current_setting('%s'), 'hex')" % name, []
+
+
+def session_keys():
+    """
+    Returns every key of every encrypted field (including keyring keys).
+    """
+    from .fields import BaseEncryptedField
+
+    keys = []
+    for model in apps.get_models():
+        for field in model._meta.concrete_fields:
+            if isinstance(field, BaseEncryptedField):
+                keys.extend(key for key in field.get_keys() if key not in keys)
+    return keys
+
+
+def bind_session_keys(connection, **kwargs):
+    """
+    A connection_created receiver that binds the keys of every encrypted field to
+    settings of the new session (see PGCRYPTO_SESSION_KEYS), so queries can refer
+    to them by name instead of sending them as parameters. This runs before the
+    connection starts any transaction, so a rollback can't unset them.
+    """
+    if connection.vendor != "postgresql":
+        return
+    names = {key: setting_name(key) for key in session_keys()}
+    if names:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT %s" % ", ".join(["set_config(%s, %s, false)"] * len(names)),
+                [value for key, name in names.items() for value in (name, key.hex())],
+            )
+    setattr(connection, SESSION_KEYS, names)
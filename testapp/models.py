@@ -1,3 +1,4 @@
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 import pgcrypto
@@ -34,3 +35,22 @@ class RawEmployee(models.Model):
     class Meta:
         db_table = "testapp_employee"
         managed = False
+
+
+class Customer(models.Model):
+    name = models.CharField(max_length=200)
+    ssn = pgcrypto.EncryptedCharField(blind_index=True, blank=True)
+    salary = pgcrypto.EncryptedDecimalField(blind_index=True, indexable=True, null=True)
+    email = pgcrypto.EncryptedEmailField(
+        deterministic_lookups=True, token_index=True, null=True
+    )
+    notes = pgcrypto.EncryptedTextField(lazy=True, blank=True)
+    last_visit = pgcrypto.EncryptedDateTimeField(blind_index=True, null=True)
+
+    objects = pgcrypto.EncryptedManager()
+
+    class Meta:
+        indexes = [GinIndex(fields=["email_tokens"], name="customer_email_tokens")]
+
+    def __str__(self):
+        return self.name
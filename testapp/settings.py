@@ -5,6 +5,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 SECRET_KEY = "django_pgcrypto_tests__this_is_not_very_secret"
 
 INSTALLED_APPS = [
+    "pgcrypto",
     "testapp",
 ]
 
@@ -1,25 +1,60 @@
+import base64
 import datetime
 import decimal
+import io
 import json
 import os
+import pickle
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 from cryptography.hazmat.primitives.ciphers.algorithms import AES
 from django import forms
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
 from django.db import connections, transaction
-from django.db.models import Value
+from django.db.models import ExpressionWrapper, F, TextField, Value
 from django.db.models.fields import CharField
 from django.db.models.functions import Concat
 from django.db.utils import IntegrityError
-from django.test import TestCase
-
-from pgcrypto import __version__, armor, dearmor, pad, unpad
-from pgcrypto.fields import BaseEncryptedField
-from pgcrypto.functions import Decrypt, Encrypt
-
-from .models import Employee
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from pgcrypto import (
+    ArmorDecoder,
+    ArmorEncoder,
+    __version__,
+    aes_pad_key,
+    armor,
+    armor_file,
+    armor_headers,
+    dearmor,
+    dearmor_file,
+    diagnostics,
+    instrumentation,
+    pad,
+    unpad,
+)
+from pgcrypto.base import crc24, crc24_bytewise, crc24_sliced
+from pgcrypto.fields import (
+    BaseEncryptedField,
+    EncryptedDateField,
+    EncryptedDateTimeField,
+    EncryptedDecimalField,
+    EncryptedIntegerField,
+    EncryptedTextField,
+)
+from pgcrypto.functions import Dearmor, Decrypt, Encrypt
+from pgcrypto.indexes import EncryptedIndex
+from pgcrypto.maintenance import rekeyed_field, rotate_keys
+from pgcrypto.operations import CreateDecryptFunctions
+from pgcrypto.query import EncryptedQuerySet, decrypt_parallel, shard_field
+from pgcrypto.session import SESSION_KEYS, bind_session_keys, setting_name
+
+from .models import Customer, Employee
 
 
 class CryptoTests(unittest.TestCase):
@@ -47,10 +82,282 @@ class CryptoTests(unittest.TestCase):
             unpad(f.decrypt(self.encrypt_aes), f.block_size), b"sensitive information"
         )
 
+    def test_cipher_cache(self):
+        f = BaseEncryptedField(cipher="aes", key=b"pass")
+        cipher = f.get_cipher()
+        self.assertIs(f.get_cipher(), cipher)
+        self.assertEqual(f.decrypt(f.encrypt(self.encrypt_aes)), self.encrypt_aes)
+        # Changing the key throws away the cached cipher.
+        f.cipher_key = aes_pad_key(b"secret")
+        self.assertIsNot(f.get_cipher(), cipher)
+        self.assertEqual(
+            unpad(f.decrypt(self.encrypt_aes_padded), f.block_size), b"xxxxxxxxxxxxxxxx"
+        )
+
+    def test_decrypt_cache(self):
+        f = EncryptedIntegerField(key=b"pass", decrypt_cache_size=2)
+        values = [f.get_db_prep_save(n, None) for n in (1, 2, 1, 3)] + [None]
+        self.assertEqual(f.from_db_values(values), [1, 2, 1, 3, None])
+        self.assertEqual(f.cache_info(), (0, 4, 2, 2))
+        self.assertEqual(f.to_python(values[2]), 1)
+        self.assertEqual(f.to_python(values[1]), 2)
+        self.assertEqual(f.cache_info().hits, 0)
+        self.assertEqual(f.to_python(values[0]), 1)
+        self.assertEqual(f.cache_info(), (1, 6, 2, 2))
+        # Changing the key empties the cache.
+        f.cipher_key = aes_pad_key(b"secret")
+        self.assertEqual(f.cache_info(), (0, 0, 2, 0))
+        self.assertIsNone(EncryptedIntegerField().cache_info())
+
+    def test_encrypt_cache(self):
+        f = EncryptedIntegerField(key=b"pass", encrypt_cache_size=10)
+        uncached = EncryptedIntegerField(key=b"pass")
+        value = f.get_db_prep_save(42, None)
+        self.assertEqual(value, uncached.get_db_prep_save(42, None))
+        self.assertIs(f.get_db_prep_save(42, None), value)
+        self.assertEqual(
+            f.get_db_prep_save_many([42, 7]), [value, f.get_db_prep_save(7, None)]
+        )
+        self.assertEqual(f.get_ciphertext(42), dearmor(value))
+        self.assertEqual(f.encrypt_cache_info(), (3, 3, 10, 3))
+        f.cipher_key = aes_pad_key(b"secret")
+        self.assertEqual(f.encrypt_cache_info(), (0, 0, 10, 0))
+        self.assertNotEqual(f.get_db_prep_save(42, None), value)
+
+    def test_analyze_plan(self):
+        decrypt = (
+            "decrypt(dearmor(NULLIF(ssn, ''::text)), '\\x6b6579'::bytea, 'aes'::text)"
+        )
+        scan = {
+            "Node Type": "Seq Scan",
+            "Relation Name": "testapp_customer",
+            "Parent Relationship": "Inner",
+            "Plan Rows": 1,
+            "Filter": "(convert_from(%s, 'utf-8'::name) ~~ '%%1%%'::text)" % decrypt,
+        }
+        loop = {
+            "Node Type": "Nested Loop",
+            "Plans": [{"Node Type": "Seq Scan", "Plan Rows": 3}, scan],
+        }
+        (predicate,) = diagnostics.analyze_plan([{"Plan": loop}], lambda table: 100)
+        self.assertEqual(predicate.field, "testapp.Customer.ssn")
+        self.assertEqual(predicate.node, "Seq Scan on testapp_customer")
+        self.assertEqual(predicate.rows, 300)
+        self.assertNotIn("6b6579", predicate.condition)
+        scan.update({"Actual Rows": 1, "Actual Loops": 3, "Rows Removed by Filter": 9})
+        (predicate,) = diagnostics.analyze_plan([{"Plan": loop}], lambda table: 100)
+        self.assertEqual(predicate.rows, 30)
+        with self.assertRaises(ValueError):
+            diagnostics.QueryChecker(threshold=10, action="ignore")
+
+    def test_install_checker(self):
+        connection = mock.Mock(vendor="postgresql", execute_wrappers=[])
+        with override_settings(DEBUG=False, PGCRYPTO_EXPLAIN_THRESHOLD=10):
+            diagnostics.install_checker(connection)
+            self.assertEqual(connection.execute_wrappers, [])
+            with override_settings(PGCRYPTO_EXPLAIN_QUERIES=True):
+                diagnostics.install_checker(connection)
+                diagnostics.install_checker(connection)
+        (checker,) = connection.execute_wrappers
+        self.assertEqual(checker.threshold, 10)
+
+    def test_instrumentation(self):
+        f = EncryptedIntegerField(key=b"pass")
+        value = f.get_db_prep_save(42, None)
+        exported = []
+        instrumentation.enable(lambda *args: exported.append(args[:3]))
+        self.addCleanup(instrumentation.disable)
+        instrumentation.stats.reset()
+        self.assertEqual(f.to_python(value), 42)
+        self.assertEqual(f.from_db_values([value, value]), [42, 42])
+        self.assertEqual(f.get_db_prep_save(42, None), value)
+        stats = instrumentation.stats.snapshot()
+        self.assertEqual(stats["EncryptedIntegerField", "decrypt"][:2], (3, 48))
+        self.assertEqual(stats["EncryptedIntegerField", "parse"][:2], (3, 6))
+        self.assertEqual(stats["EncryptedIntegerField", "armor"][:2], (1, 16))
+        self.assertEqual(exported[0], ("EncryptedIntegerField", "dearmor", 1))
+        instrumentation.disable()
+        self.assertFalse(hasattr(BaseEncryptedField.decrypt, "__wrapped__"))
+        count = len(exported)
+        f.to_python(value)
+        self.assertEqual(len(exported), count)
+
+    def test_keyring(self):
+        legacy = BaseEncryptedField(key="old", versioned=True)
+        f = BaseEncryptedField(
+            key="old", versioned=True, keyring={"2": "new", "1": "older"}
+        )
+        self.assertEqual(f.key_id, "2")
+        self.assertEqual(f.active_key, aes_pad_key(b"new"))
+        value = f.get_db_prep_save("secret", None)
+        self.assertEqual(armor_headers(value)["Key-ID"], "2")
+        self.assertEqual(f.to_python(value), "secret")
+        older = BaseEncryptedField(versioned=True, keyring={"1": "older"})
+        values = [
+            value,
+            older.get_db_prep_save("older secret", None),
+            legacy.get_db_prep_save("legacy secret", None),
+            None,
+        ]
+        self.assertEqual(
+            f.from_db_values(values),
+            ["secret", "older secret", "legacy secret", None],
+        )
+        with self.assertRaises(ValueError):
+            older.to_python(value)
+        # Unversioned fields can't name their key, so they don't use the keyring.
+        f = BaseEncryptedField(key="old", keyring={"2": "new"})
+        self.assertIsNone(f.key_id)
+        self.assertEqual(legacy.to_python(f.get_db_prep_save("x", None)), "x")
+
+    def test_bytea_storage(self):
+        f = BaseEncryptedField(storage="bytea", keyring={"2": "new"}, versioned=True)
+        self.assertEqual(f.get_internal_type(), "BinaryField")
+        self.assertEqual(f.deconstruct()[3]["storage"], "bytea")
+        self.assertEqual(f.keyring, {})
+        value = f.get_db_prep_save("secret", None)
+        self.assertIsInstance(value, bytes)
+        self.assertEqual(value, f.get_ciphertext("secret"))
+        self.assertEqual(f.to_python(memoryview(value)), "secret")
+        self.assertEqual(f.get_db_prep_save("", None), b"")
+        self.assertEqual(
+            f.from_db_values([value, memoryview(b""), None]), ["secret", "", None]
+        )
+        with self.assertRaises(ValueError):
+            BaseEncryptedField(storage="blob")
+
+    def test_tokens(self):
+        f = EncryptedTextField(token_index=True, token_size=3)
+        self.assertEqual(f.deconstruct()[3]["token_size"], 3)
+        tokens = set(f.get_tokens("Alice@Example.com"))
+        self.assertEqual(
+            tokens, set(f.get_tokens(f.get_db_prep_save("alice@example.com", None)))
+        )
+        for lookup, pattern in [
+            ("icontains", "CE@EX"),
+            ("contains", "example"),
+            ("startswith", "al"),
+            ("istartswith", "A"),
+            ("endswith", ".com"),
+        ]:
+            search = f.get_search_tokens(pattern, lookup)
+            self.assertTrue(search)
+            self.assertLessEqual(set(search), tokens)
+        # Too short to narrow anything down.
+        self.assertEqual(f.get_search_tokens("ex", "contains"), [])
+        self.assertEqual(f.get_search_tokens("m", "endswith"), [])
+        self.assertFalse(set(f.get_search_tokens("lice", "startswith")) <= tokens)
+        self.assertIsNone(f.get_tokens(""))
+        # Final sigma lowercases differently at the end of the pattern than inside
+        # the value, and dotless i doesn't casefold to i, but both uppercase the same
+        # (as UPPER() does in the database).
+        self.assertLessEqual(
+            set(f.get_search_tokens("ΑΑΣ", "icontains")), set(f.get_tokens("ΑΑΣΑ"))
+        )
+        self.assertLessEqual(
+            set(f.get_search_tokens("kırmızı", "icontains")),
+            set(f.get_tokens("KIRMIZI")),
+        )
+        with self.assertRaises(ValueError):
+            EncryptedIntegerField(token_index=True)
+
+    def test_binary_codecs(self):
+        cases = [
+            (EncryptedIntegerField, [-129, 2**70, "42"]),
+            (
+                EncryptedDecimalField,
+                [decimal.Decimal("52000.00"), decimal.Decimal("-1.50")],
+            ),
+            (EncryptedDateField, [datetime.date(1, 1, 1), datetime.date(2024, 2, 29)]),
+            (
+                EncryptedDateTimeField,
+                [timezone.now(), datetime.datetime(2020, 1, 2, 3, 4, 5, 6)],
+            ),
+        ]
+        for field_class, values in cases:
+            f = field_class(codec="binary")
+            text = field_class()
+            for value in values:
+                stored = f.get_db_prep_save(value, None)
+                self.assertEqual(f.to_python(stored), text.to_python(value))
+                self.assertEqual(f.from_db_values([stored]), [f.to_python(stored)])
+                # Every value fits in a single block.
+                self.assertEqual(len(dearmor(stored)), 16)
+        with self.assertRaises(ValueError):
+            EncryptedTextField(codec="binary")
+        with self.assertRaises(ValueError):
+            EncryptedIntegerField(codec="binary", indexable=True)
+        for field_class in (EncryptedDateField, EncryptedDateTimeField):
+            with self.assertRaises(ValueError):
+                field_class(indexable=True)
+        with self.assertRaises(ValueError):
+            EncryptedDecimalField(deterministic_lookups=True)
+
     def test_armor_dearmor(self):
         a = armor(self.encrypt_aes)
         self.assertEqual(dearmor(a), self.encrypt_aes)
 
+    def test_armor_stream(self):
+        data = self.encrypt_aes * 1000
+        encoder = ArmorEncoder()
+        armored = "".join(
+            encoder.update(data[i : i + 100]) for i in range(0, 32000, 100)
+        )
+        armored += encoder.finalize()
+        self.assertEqual(armored, armor(data))
+        decoder = ArmorDecoder()
+        decoded = b"".join(
+            decoder.update(armored[i : i + 37]) for i in range(0, len(armored), 37)
+        )
+        decoded += decoder.finalize()
+        self.assertEqual(decoded, data)
+        # Round-trip through file-like objects, a few bytes at a time.
+        text = io.StringIO()
+        armor_file(io.BytesIO(data), text, chunk_size=10)
+        self.assertEqual(text.getvalue(), armored)
+        output = io.BytesIO()
+        dearmor_file(io.StringIO(armored), output, chunk_size=10)
+        self.assertEqual(output.getvalue(), data)
+
+    def test_crc24(self):
+        # Checksum line from the armored value in test_encrypt_function.
+        data = base64.b64decode("S3CgYGeFb6yTyQZVW00n9Q==")
+        self.assertEqual(crc24(data), 0x22E12D)
+        long_data = data * 20
+        expected = crc24_bytewise(long_data)
+        self.assertEqual(crc24_sliced(long_data), expected)
+        self.assertEqual(crc24(bytearray(long_data)), expected)
+        self.assertEqual(crc24(memoryview(long_data)), expected)
+        self.assertEqual(crc24(long_data[100:], crc24(long_data[:100])), expected)
+
+    def test_from_db_values(self):
+        f = EncryptedDecimalField(key=b"pass")
+        values = [f.get_db_prep_save(n, None) for n in ("1.50", "-2", "3" * 40)]
+        values += [None, ""]
+        self.assertEqual(
+            f.from_db_values(values), [f.from_db_value(v, None, None) for v in values]
+        )
+        self.assertEqual(f.from_db_values([]), [])
+
+    def test_get_db_prep_save_many(self):
+        f = EncryptedDecimalField(key=b"pass")
+        values = ["1.50", "-2", "3" * 40, None, "", f.get_db_prep_save("4", None)]
+        self.assertEqual(
+            f.get_db_prep_save_many(values),
+            [f.get_db_prep_save(v, None) for v in values],
+        )
+        self.assertEqual(f.get_db_prep_save_many([]), [])
+
+    def test_decrypt_parallel(self):
+        f = EncryptedDecimalField(key=b"pass")
+        values = [f.get_db_prep_save(n, None) for n in range(50)]
+        expected = f.from_db_values(values)
+        with ThreadPoolExecutor(3) as executor:
+            self.assertEqual(decrypt_parallel(f, values, executor, 3), expected)
+        # Worker processes get an unbound copy of the field, with the same key.
+        copy = pickle.loads(pickle.dumps(shard_field(f)))
+        self.assertEqual(copy.from_db_values(values), expected)
+
     def test_aes(self):
         f = BaseEncryptedField(cipher="aes", key=b"pass")
         self.assertEqual(
@@ -85,6 +392,19 @@ class FieldTests(TestCase):
                 self.assertEqual(e.salary, decimal.Decimal(obj["fields"]["salary"]))
                 self.assertEqual(e.date_hired.isoformat(), obj["fields"]["date_hired"])
 
+    def test_batch_decrypt(self):
+        fields = ("pk", "age", "ssn", "salary", "date_hired", "email", "date_modified")
+        expected = list(Employee.objects.order_by("pk").values_list(*fields))
+        qs = EncryptedQuerySet(Employee).order_by("pk")
+        self.assertEqual(list(qs.values_list(*fields)), expected)
+        self.assertEqual(
+            [tuple(getattr(e, f) for f in fields) for e in qs.iterator(chunk_size=1)],
+            expected,
+        )
+        self.assertEqual(qs.filter(ssn="666-27-9811").get().name, "Sally Johnson")
+        with mock.patch("pgcrypto.query.PARALLEL_MIN_SHARD", 1):
+            self.assertEqual(list(qs.parallel(2).values_list(*fields)), expected)
+
     def test_decimal_lookups(self):
         self.assertEqual(
             Employee.objects.filter(salary=decimal.Decimal("75248.77")).count(), 1
@@ -293,3 +613,390 @@ class FieldTests(TestCase):
     def test_iendswith(self):
         employee = Employee.objects.filter(email__iendswith="COM").get()
         self.assertEqual(employee.email, "johnson.sally@example.com")
+
+
+class IndexedLookupTests(TestCase):
+    def setUp(self):
+        c = connections["default"].cursor()
+        c.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto")
+        self.alice = Customer.objects.create(
+            name="Alice",
+            ssn="999-05-6728",
+            salary=decimal.Decimal("52000.00"),
+            email="alice@example.com",
+        )
+        self.bob = Customer.objects.create(
+            name="Bob", ssn="666-27-9811", email="bob@example.com"
+        )
+
+    def test_lookups(self):
+        qs = Customer.objects.filter(ssn="999-05-6728")
+        self.assertIn("ssn_bidx", str(qs.query))
+        self.assertNotIn("decrypt", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+        self.assertEqual(
+            Customer.objects.filter(ssn__in=["666-27-9811", "000-00-0000"]).get(),
+            self.bob,
+        )
+        # Equal decimals hash the same, however they are written.
+        self.assertEqual(Customer.objects.get(salary=52000), self.alice)
+        self.assertEqual(Customer.objects.filter(ssn="").count(), 0)
+        carol = Customer.objects.create(name="Carol", salary=0)
+        self.assertEqual(Customer.objects.get(salary=0), carol)
+        self.assertEqual(Customer.objects.get(salary=0.0), carol)
+        self.assertEqual(Customer.objects.get(salary=decimal.Decimal("-0.00")), carol)
+
+    def test_deterministic_lookups(self):
+        qs = Customer.objects.filter(email="alice@example.com")
+        self.assertNotIn("decrypt", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+        self.assertEqual(
+            Customer.objects.filter(
+                email__in=["bob@example.com", "carol@example.com"]
+            ).get(),
+            self.bob,
+        )
+        # Armor headers don't affect matching.
+        f = Customer._meta.get_field("email")
+        raw = armor(f.get_ciphertext("carol@example.com"), versioned=True)
+        Customer.objects.filter(pk=self.bob.pk).update(email=raw)
+        self.assertEqual(Customer.objects.get(email="carol@example.com"), self.bob)
+        bob = Customer.objects.annotate(raw=Dearmor("email")).get(pk=self.bob.pk)
+        self.assertEqual(bytes(bob.raw), f.get_ciphertext("carol@example.com"))
+
+    def test_datetime_blind_index(self):
+        with timezone.override(datetime.timezone(datetime.timedelta(hours=2))):
+            self.alice.last_visit = datetime.datetime(2024, 1, 1, 12, 0)
+            self.alice.save()
+        with timezone.override(datetime.timezone.utc):
+            self.assertEqual(
+                Customer.objects.get(last_visit=datetime.datetime(2024, 1, 1, 10, 0)),
+                self.alice,
+            )
+        utc = datetime.datetime(2024, 1, 1, 10, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(Customer.objects.get(last_visit=utc), self.alice)
+        qs = Customer.objects.filter(last_visit="2024-01-01T12:00:00+02:00")
+        self.assertIn("last_visit_bidx", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+
+    def test_updates(self):
+        Customer.objects.filter(pk=self.alice.pk).update(ssn="123-45-6789")
+        self.assertEqual(Customer.objects.get(ssn="123-45-6789"), self.alice)
+        self.bob.ssn = "987-65-4321"
+        Customer.objects.bulk_update([self.bob], ["ssn"])
+        self.assertEqual(Customer.objects.get(ssn="987-65-4321"), self.bob)
+
+    def test_backfill(self):
+        Customer.objects.update(ssn_bidx=None, salary_bidx=None)
+        self.assertFalse(Customer.objects.filter(ssn="999-05-6728").exists())
+        call_command(
+            "pgcrypto_backfill", "testapp.Customer", batch_size=1, stdout=io.StringIO()
+        )
+        self.assertEqual(Customer.objects.get(ssn="999-05-6728"), self.alice)
+        self.assertEqual(
+            Customer.objects.get(salary=decimal.Decimal("52000")), self.alice
+        )
+
+    def test_encrypted_index(self):
+        index = EncryptedIndex(fields=["salary"], name="customer_salary_decrypted")
+        self.assertEqual(index.clone().deconstruct()[2]["fields"], ["salary"])
+        connection = connections["default"]
+        with connection.schema_editor() as editor:
+            CreateDecryptFunctions().database_forwards("testapp", editor, None, None)
+            editor.add_index(Customer, index)
+        qs = Customer.objects.filter(salary__gte=50000)
+        self.assertIn("pgcrypto_decrypt_numeric", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+        with connection.cursor() as c:
+            c.execute("SET enable_seqscan = off")
+        self.assertIn("customer_salary_decrypted", qs.explain())
+
+    def test_ordering(self):
+        # Indexable fields are ordered through the decrypt functions.
+        with connections["default"].schema_editor() as editor:
+            CreateDecryptFunctions().database_forwards("testapp", editor, None, None)
+        carol = Customer.objects.create(name="Carol", salary=decimal.Decimal("9000"))
+        # 9000 sorts after 52000 as text, but not as a number.
+        self.assertEqual(
+            list(Customer.objects.order_by("salary")), [carol, self.alice, self.bob]
+        )
+        self.assertEqual(Customer.objects.order_by("-salary", "name")[1], self.alice)
+        self.assertEqual(
+            list(Customer.objects.order_by("-email").values_list("name", flat=True)),
+            ["Carol", "Bob", "Alice"],
+        )
+
+    def test_rotate_keys(self):
+        field = Customer._meta.get_field("ssn")
+        rows = list(rotate_keys(Customer, field.cipher_key, "new key", batch_size=1))
+        self.assertEqual(rows, [(1, self.alice.pk), (1, self.bob.pk)])
+        raw = Customer.objects.values_list(
+            ExpressionWrapper(F("ssn"), TextField()), flat=True
+        ).get(pk=self.alice.pk)
+        self.assertEqual(rekeyed_field(field, "new key").to_python(raw), "999-05-6728")
+        with self.assertRaises(CommandError):
+            call_command("pgcrypto_rotate", "testapp.Customer", stdout=io.StringIO())
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, {"PGCRYPTO_ROTATE_OLD_KEY": "new key"}):
+            call_command(
+                "pgcrypto_rotate", "testapp.Customer", streaming=True, stdout=out
+            )
+        self.assertIn("Rotated 2 rows", out.getvalue())
+        alice = Customer.objects.get(ssn="999-05-6728")
+        self.assertEqual(alice.salary, decimal.Decimal("52000.00"))
+        self.assertEqual(Customer.objects.get(email="bob@example.com"), self.bob)
+
+    def test_keyring(self):
+        field = Customer._meta.get_field("ssn")
+        keyring = {"2": aes_pad_key(b"new key")}
+        with mock.patch.multiple(field, versioned=True, keyring=keyring, key_id="2"):
+            carol = Customer.objects.create(name="Carol", ssn="999-05-0000")
+            raw = Customer.objects.values_list(
+                ExpressionWrapper(F("ssn"), TextField()), flat=True
+            ).get(pk=carol.pk)
+            self.assertIn("Key-ID: 2", raw)
+            # Both keys are used for decrypting in the database.
+            self.assertEqual(
+                list(Customer.objects.filter(ssn__startswith="999-05").order_by("pk")),
+                [self.alice, carol],
+            )
+            call_command(
+                "pgcrypto_rotate",
+                "testapp.Customer",
+                streaming=True,
+                stdout=io.StringIO(),
+            )
+            self.assertEqual(Customer.objects.get(ssn="999-05-6728"), self.alice)
+            raw = Customer.objects.values_list(
+                ExpressionWrapper(F("ssn"), TextField()), flat=True
+            ).get(pk=self.alice.pk)
+            self.assertIn("Key-ID: 2", raw)
+
+    def test_rotate_lazy(self):
+        field = Customer._meta.get_field("notes")
+        self.alice.notes = "Prefers email"
+        self.alice.save()
+        rotated = rotate_keys(
+            Customer,
+            field.cipher_key,
+            "brand new key",
+            fields=["notes"],
+            streaming=True,
+        )
+        self.assertEqual(list(rotated), [(2, self.bob.pk)])
+        raw = Customer.objects.values_list(
+            ExpressionWrapper(F("notes"), TextField()), flat=True
+        ).get(pk=self.alice.pk)
+        new = rekeyed_field(field, "brand new key")
+        self.assertEqual(new.to_python(raw), "Prefers email")
+
+    def test_rotate_keyring_only(self):
+        field = Customer._meta.get_field("ssn")
+        keyring = {"2": aes_pad_key(b"new key")}
+        with mock.patch.multiple(field, versioned=True, keyring=keyring, key_id="2"):
+            with CaptureQueriesContext(connections["default"]) as queries:
+                list(rotate_keys(Customer))
+        (update,) = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+        # Fields without a keyring already use the key they'd be rotated onto.
+        self.assertIn('"ssn" =', update)
+        self.assertNotIn('"email" =', update)
+        self.assertEqual(list(rotate_keys(Customer, "same", "same")), [])
+
+    def test_lazy(self):
+        Customer.objects.filter(pk=self.alice.pk).update(notes="Prefers email.")
+        raw = Customer.objects.values_list(
+            ExpressionWrapper(F("notes"), TextField()), flat=True
+        ).get(pk=self.alice.pk)
+        alice = Customer.objects.get(pk=self.alice.pk)
+        # Nothing is decrypted until the attribute is read.
+        self.assertEqual(alice.__dict__["notes"], raw)
+        alice.name = "Alice Smith"
+        alice.save()
+        self.assertEqual(alice.__dict__["notes"], raw)
+        self.assertEqual(alice.notes, "Prefers email.")
+        alice.save()
+        self.assertEqual(
+            Customer.objects.values_list(
+                ExpressionWrapper(F("notes"), TextField()), flat=True
+            ).get(pk=self.alice.pk),
+            raw,
+        )
+        alice.notes = "Prefers phone."
+        alice.save()
+        self.assertEqual(
+            Customer.objects.values_list("notes", flat=True).get(pk=self.alice.pk),
+            "Prefers phone.",
+        )
+        self.assertEqual(Customer.objects.get(pk=self.alice.pk).notes, "Prefers phone.")
+
+    def test_bulk_create(self):
+        customers = [
+            Customer(name="Carol", ssn="999-05-0000", salary=decimal.Decimal("1.50")),
+            Customer(name="Dave", ssn="999-05-0001"),
+        ]
+        with self.assertLogs("pgcrypto", "DEBUG") as logs:
+            Customer.objects.bulk_create(customers)
+        self.assertIn("bulk_create of 2 testapp.Customer objects", logs.output[0])
+        # The objects keep their plaintext values.
+        self.assertEqual(customers[0].ssn, "999-05-0000")
+        self.assertEqual(
+            Customer.objects.get(ssn="999-05-0000").salary, decimal.Decimal("1.50")
+        )
+        for customer in customers:
+            customer.ssn = customer.ssn.replace("999", "123")
+        Customer.objects.parallel(2).bulk_update(customers, ["ssn"])
+        self.assertEqual(Customer.objects.get(ssn="123-05-0001").name, "Dave")
+        # The same object more than once is encrypted (and restored) once.
+        customers[0].ssn = "123-05-9999"
+        Customer.objects.bulk_update([customers[0], customers[0]], ["ssn"])
+        self.assertEqual(customers[0].ssn, "123-05-9999")
+        self.assertEqual(Customer.objects.get(ssn="123-05-9999").name, "Carol")
+
+    def test_instrumentation(self):
+        instrumentation.enable()
+        self.addCleanup(instrumentation.disable)
+        instrumentation.stats.reset()
+        queries = []
+
+        def capture(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connections["default"].execute_wrapper(capture):
+            customer = Customer.objects.get(ssn="999-05-6728", salary=52000)
+        self.assertEqual(customer, self.alice)
+        self.assertTrue(queries[-1].endswith(" /*pgcrypto_predicates=2*/"))
+        self.assertNotIn("/*pgcrypto:", queries[-1])
+        stats = instrumentation.stats.snapshot()
+        self.assertEqual(stats["testapp.Customer.ssn", "lookup"].count, 1)
+        self.assertEqual(stats["testapp.Customer.salary", "lookup"].count, 1)
+        self.assertEqual(stats["testapp.Customer.ssn", "decrypt"].count, 1)
+
+    def test_decrypt_in_db(self):
+        qs = Customer.objects.decrypt_in_db().order_by("pk")
+        self.assertEqual(
+            list(qs.values_list("ssn", "salary", "email")),
+            [
+                ("999-05-6728", decimal.Decimal("52000.00"), "alice@example.com"),
+                ("666-27-9811", None, "bob@example.com"),
+            ],
+        )
+        with mock.patch.object(
+            BaseEncryptedField, "decrypt_many", side_effect=AssertionError
+        ):
+            customer = qs.get(pk=self.alice.pk)
+        self.assertEqual(customer.salary, decimal.Decimal("52000.00"))
+        self.assertEqual(customer.notes, "")
+        self.assertNotIn("decrypt(", str(qs.decrypt_in_db(None).query))
+        self.assertNotIn(
+            "decrypt(", str(qs.decrypt_in_db("salary").values("email").query)
+        )
+        with self.assertRaises(ValueError):
+            Customer.objects.decrypt_in_db("name")
+
+    def test_session_keys(self):
+        connection = connections["default"]
+        bind_session_keys(connection)
+        self.addCleanup(delattr, connection, SESSION_KEYS)
+        field = Customer._meta.get_field("ssn")
+        qs = Customer.objects.filter(ssn__contains="05-67")
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+        self.assertIn("current_setting('%s')" % setting_name(field.cipher_key), sql)
+        self.assertNotIn(field.cipher_key, params)
+        self.assertEqual(qs.get(), self.alice)
+        self.assertEqual(Customer.objects.order_by("-ssn").first(), self.alice)
+
+    @override_settings(PGCRYPTO_IN_ARRAY_THRESHOLD=2)
+    def test_large_in(self):
+        others = ["000-00-0001", "000-00-0002"]
+        qs = Customer.objects.filter(ssn__in=[*others, "999-05-6728"])
+        self.assertIn("= ANY(", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+        self.assertNotIn("= ANY(", str(Customer.objects.filter(ssn__in=others).query))
+        qs = Customer.objects.filter(email__in=[*others, "bob@example.com"])
+        self.assertIn("::bytea[]", str(qs.query))
+        self.assertEqual(qs.get(), self.bob)
+        employee = Employee.objects.create(
+            name="Carol", age=30, ssn="1", salary=decimal.Decimal("1.00")
+        )
+        qs = Employee.objects.filter(age__in=[1, "2", 30])
+        self.assertIn("::integer[]", str(qs.query))
+        self.assertEqual(qs.get(), employee)
+
+    def test_token_index(self):
+        qs = Customer.objects.filter(email__icontains="ALICE@")
+        self.assertIn("email_tokens", str(qs.query))
+        self.assertEqual(qs.get(), self.alice)
+        self.assertEqual(
+            Customer.objects.filter(email__startswith="bob").get(), self.bob
+        )
+        qs = Customer.objects.filter(email__contains="ob")
+        self.assertNotIn("email_tokens", str(qs.query))
+        Customer.objects.filter(pk=self.bob.pk).update(email="carol@example.com")
+        # Rows are only compared if their tokens match, so need backfilling.
+        Customer.objects.update(email_tokens=None)
+        self.assertFalse(Customer.objects.filter(email__endswith="ple.com").exists())
+        call_command(
+            "pgcrypto_backfill",
+            "testapp.Customer",
+            fields=["email"],
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(Customer.objects.filter(email__endswith="ple.com").count(), 2)
+        self.assertFalse(Customer.objects.filter(email__contains="bob").exists())
+
+    def test_update_fields(self):
+        # Index columns are written even when update_fields leaves them out.
+        self.alice.ssn = "123-45-6789"
+        self.alice.email = "carol@example.com"
+        self.alice.save(update_fields=["ssn", "email"])
+        self.assertEqual(Customer.objects.get(ssn="123-45-6789"), self.alice)
+        self.assertEqual(
+            Customer.objects.values_list("email_tokens", flat=True).get(
+                pk=self.alice.pk
+            ),
+            Customer._meta.get_field("email").get_tokens("carol@example.com"),
+        )
+
+    def test_explain(self):
+        qs = Customer.objects.filter(email__icontains="example", ssn="999-05-6728")
+        (predicate,) = diagnostics.explain(qs)
+        self.assertEqual(predicate.field, "testapp.Customer.email")
+        self.assertTrue(predicate.node.endswith(" on testapp_customer"))
+        self.assertFalse(predicate.indexed)
+        self.assertEqual(diagnostics.explain(Customer.objects.filter(ssn="1")), [])
+        (predicate,) = diagnostics.explain(
+            Customer.objects.filter(email__icontains="example"), analyze=True
+        )
+        self.assertEqual(predicate.rows, 2)
+        with self.assertWarns(diagnostics.ExpensiveDecryptionWarning):
+            diagnostics.check(qs, threshold=0)
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command(
+                "pgcrypto_explain",
+                "testapp.Customer",
+                "email__icontains=example",
+                threshold=0,
+                stdout=out,
+            )
+        self.assertIn("testapp.Customer.email: ~", out.getvalue())
+        checker = diagnostics.QueryChecker(threshold=0, action="raise")
+        with connections["default"].execute_wrapper(checker):
+            self.assertEqual(Customer.objects.get(ssn="999-05-6728"), self.alice)
+            with self.assertRaises(diagnostics.ExpensiveDecryptionError):
+                list(qs)
+
+    async def test_aiterator(self):
+        qs = Customer.objects.order_by("pk")
+        customers = [c async for c in qs.aiterator(chunk_size=1)]
+        self.assertEqual([c.ssn for c in customers], ["999-05-6728", "666-27-9811"])
+        self.assertEqual(customers[0].salary, decimal.Decimal("52000.00"))
+        with ThreadPoolExecutor(2) as pool:
+            emails = [
+                email
+                async for email in qs.parallel(executor=pool)
+                .values_list("email", flat=True)
+                .aiterator()
+            ]
+        self.assertEqual(emails, ["alice@example.com", "bob@example.com"])